@@ -0,0 +1,238 @@
+"""
+HTTP ingestion API.
+
+Lets other internal systems push documents without driving the Streamlit
+UI. It runs the same extraction pipeline as the app (see extraction.py)
+against the same result store, so page checkpoints, reuse of prior
+extractions and the process-wide rate limit apply to both.
+
+Asynchronous requests are queued in the shared job store (see jobs.py) and
+run by worker processes (see worker.py), or by OGAR_API_WORKERS workers
+started in this process.
+
+Requests are charged to the budgets of budget.py under the caller
+identified by its token (see check_token), and refused with 429 over budget.
+
+Run with:
+    uvicorn api:app --host 0.0.0.0 --port 8000
+"""
+import os
+from collections import Counter
+from typing import List
+
+from anthropic import Anthropic
+from fastapi import Depends, FastAPI, File, Form, Header, HTTPException, UploadFile
+from fastapi.responses import JSONResponse
+
+from budget import BudgetExceeded, admit, estimate_upload, estimated_cost, estimated_seconds, settle, total
+from extraction import ARCHIVE_EXTENSIONS, DOCUMENT_EXTENSIONS, process_upload
+from jobs import FINISHED, batch_jobs, enqueue_batch, open_jobs, prune_jobs
+from store import open_store, load_document, load_record
+from worker import start_workers
+
+# Try to load .env file for local development
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass
+
+api_key = os.getenv('OGAR_API_KEY')
+client = Anthropic(api_key=api_key) if api_key else None
+store = open_store()
+jobs = open_jobs()
+
+# Synchronous requests run in the server's own thread pool, asynchronous
+# jobs in the workers; in process, both share the rate limiter of
+# extraction.py. Set OGAR_API_WORKERS=0 when separate workers are deployed.
+API_WORKERS = int(os.getenv('OGAR_API_WORKERS', '4'))
+JOB_RETENTION_SECONDS = int(os.getenv('OGAR_JOB_RETENTION_SECONDS', '3600'))
+if client is not None and API_WORKERS:
+    start_workers(client, store, jobs, API_WORKERS)
+
+app = FastAPI(title="OGAR Document Extraction API")
+
+# Per-caller tokens, as OGAR_API_TOKENS=name:token,other:token, each caller
+# having its own daily budget; OGAR_API_TOKEN is a secret shared by callers
+# charged together as 'api'
+API_TOKENS = {
+    token: name
+    for name, _, token in (entry.partition(':') for entry in os.getenv('OGAR_API_TOKENS', '').split(','))
+    if token
+}
+
+def check_token(authorization: str = Header(None)):
+    """
+    Authenticate the caller and return the user its budget is charged to.
+    """
+    token = os.getenv('OGAR_API_TOKEN')
+    if not API_TOKENS and not token:
+        return 'api'
+    scheme, _, value = (authorization or '').partition(' ')
+    if scheme == 'Bearer' and value in API_TOKENS:
+        return API_TOKENS[value]
+    if scheme == 'Bearer' and token and value == token:
+        return 'api'
+    raise HTTPException(status_code=401, detail="Invalid or missing API token")
+
+def read_uploads(files):
+    """
+    Return the (name, file object) of each upload. Uploads are spooled to
+    disk by the server, they are read from there rather than into memory.
+    """
+    uploads = []
+    for upload in files:
+        name = upload.filename or ''
+        if not name.lower().endswith(DOCUMENT_EXTENSIONS + ARCHIVE_EXTENSIONS):
+            raise HTTPException(status_code=400, detail=f"Unsupported file type: {name}")
+        uploads.append((name, upload.file))
+    return uploads
+
+def describe_estimate(estimate):
+    return {
+        'pages': estimate.pages,
+        'input_tokens': estimate.input_tokens,
+        'output_tokens': estimate.output_tokens,
+        'cost': round(estimated_cost(estimate), 4),
+        'seconds': round(estimated_seconds(estimate))
+    }
+
+def admit_uploads(uploads, user):
+    """
+    Estimate a list of (name, file object) uploads and reserve it on the
+    user's budget. Returns (estimate, day).
+    """
+    estimate = total(estimate_upload(fileobj, name) for name, fileobj in uploads)
+    try:
+        return estimate, admit(store, user, estimate)
+    except BudgetExceeded as e:
+        raise HTTPException(
+            status_code=429,
+            detail={'error': str(e), 'budget': e.budget, 'estimate': describe_estimate(estimate)}
+        )
+
+def build_documents(items, flatten=False):
+    documents = []
+    for key, page, source_file, display_page in items:
+        result = load_document(store, key, page)
+        document = {'source_file': source_file, 'page': display_page or None, 'data': result}
+        if flatten and result is not None:
+            # Records are memoized per document, repeated polls reuse them
+            document['fields'] = [
+                {'Categorie': categorie, 'Nom du champ': nom, 'Valeur du champ': valeur}
+                for _, categorie, nom, valeur in load_record(store, key, page).fields()
+            ]
+        documents.append(document)
+    return documents
+
+def run_extraction(uploads, force_refresh=False, flatten=False, stats=None):
+    """
+    Extract a list of (name, file object) uploads and return the response
+    body. Counts go to stats when given, so that they survive an error.
+    """
+    stats = Counter() if stats is None else stats
+    errors = []
+    documents = []
+    complete = True
+    
+    for name, fileobj in uploads:
+        items, file_complete = process_upload(
+            client, store, fileobj, name,
+            force_refresh=force_refresh,
+            on_error=lambda e, name=name: errors.append({'file': name, 'error': str(e)}),
+            stats=stats
+        )
+        complete = complete and file_complete
+        documents.extend(build_documents(items, flatten))
+    
+    return {
+        'complete': complete,
+        'documents': documents,
+        'errors': errors,
+        'stats': dict(stats)
+    }
+
+def batch_result(batch, flatten=False):
+    """
+    Response body of a finished batch, in the format of run_extraction.
+    """
+    stats = Counter()
+    errors = []
+    documents = []
+    complete = True
+    
+    for job in batch:
+        result = job['result']
+        if result is None:
+            errors.append({'file': job['name'], 'error': job['error']})
+            complete = False
+            continue
+        complete = complete and result['complete']
+        stats.update(result['stats'])
+        errors.extend({'file': job['name'], 'error': error['message']} for error in result['errors'])
+        documents.extend(build_documents(result['items'], flatten))
+    
+    return {
+        'complete': complete,
+        'documents': documents,
+        'errors': errors,
+        'stats': dict(stats)
+    }
+
+@app.get("/health")
+def health():
+    return {'status': 'ok', 'model_configured': client is not None}
+
+@app.post("/extract")
+def extract(
+    files: List[UploadFile] = File(...),
+    force_refresh: bool = Form(False),
+    flatten: bool = Form(False),
+    wait: bool = Form(True),
+    user: str = Depends(check_token)
+):
+    """
+    Extract the uploaded PDFs, images or archives.
+
+    With wait=true (default) the extraction result is returned directly.
+    With wait=false a job id is returned at once, to be polled on
+    /jobs/{job_id} (with ?flatten=true for the flattened fields).
+    Either way the response includes the pre-flight estimate; a request
+    over budget is refused with 429.
+    """
+    if client is None:
+        raise HTTPException(status_code=503, detail="Extraction service is not configured")
+    uploads = read_uploads(files)
+    estimate, day = admit_uploads(uploads, user)
+    
+    if wait:
+        stats = Counter()
+        try:
+            result = run_extraction(uploads, force_refresh, flatten, stats)
+        finally:
+            settle(store, user, estimate, stats, day)
+        result['estimate'] = describe_estimate(estimate)
+        return result
+    
+    # Queued jobs keep their estimate charged, whatever they end up using
+    prune_jobs(jobs, JOB_RETENTION_SECONDS)
+    job_id, _ = enqueue_batch(jobs, uploads, force_refresh)
+    return JSONResponse(
+        status_code=202,
+        content={'job_id': job_id, 'status': 'pending', 'estimate': describe_estimate(estimate)}
+    )
+
+@app.get("/jobs/{job_id}", dependencies=[Depends(check_token)])
+def get_job(job_id: str, flatten: bool = False):
+    batch = batch_jobs(jobs, job_id)
+    if not batch:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    
+    statuses = [job['status'] for job in batch]
+    files = [{'file': job['name'], 'status': job['status']} for job in batch]
+    if not all(status in FINISHED for status in statuses):
+        status = 'pending' if all(status == 'pending' for status in statuses) else 'running'
+        return {'job_id': job_id, 'status': status, 'files': files}
+    
+    status = 'failed' if all(status == 'failed' for status in statuses) else 'done'
+    return {'job_id': job_id, 'status': status, 'files': files, 'result': batch_result(batch, flatten)}
@@ -1,16 +1,25 @@
+# Streamlit reruns this script on every interaction: heavy modules (pandas,
+# anthropic, PDF libraries) are imported where first used, and static
+# assets are loaded once per process with st.cache_resource
 import streamlit as st
-import pandas as pd
 from PIL import Image
-import PyPDF2
-import pdf2image
 import io
-import base64
-import json
+import time
+from collections import Counter
 from datetime import datetime
 import bcrypt
 import os
-from anthropic import Anthropic
-from streamlit_option_menu import option_menu
+from store import (
+    open_store, load_document, count_fields, query_fields, list_categories, search_documents
+)
+from extraction import (
+    DEFAULT_PROMPT, DocumentReadError, content_hash, error_from_dict, is_archive_name, is_pdf_name,
+    process_upload
+)
+from jobs import FINISHED, batch_jobs, enqueue_batch, open_jobs
+from budget import (
+    BudgetExceeded, admit, estimate_upload, estimated_cost, estimated_seconds, settle, total
+)
 
 # Try to load .env file for local development
 try:
@@ -30,9 +39,23 @@ st.set_page_config(
 def hash_password(password):
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
 
+@st.cache_resource
+def default_password_hash():
+    # bcrypt is deliberately slow, hash the default password once per process
+    return hash_password("Jabe2025!@@")
+
+@st.cache_resource
+def load_logo(path):
+    try:
+        image = Image.open(path)
+        image.load()
+        return image
+    except Exception:
+        return None
+
 if 'users' not in st.session_state:
     # Pre-populate with default user
-    default_password = hash_password("Jabe2025!@@")
+    default_password = default_password_hash()
     st.session_state.users = {
         "Ogar": {
             'email': 'admin@ogar.com',
@@ -44,7 +67,13 @@ if 'logged_in' not in st.session_state:
 if 'username' not in st.session_state:
     st.session_state.username = None
 if 'extracted_data' not in st.session_state:
+    # References (file_hash, page, source_file, display_page) to results kept
+    # in the durable store; the documents themselves are not held in memory.
     st.session_state.extracted_data = []
+if 'extracted_files' not in st.session_state:
+    # uploaded file content hash -> {'items': [(store_key, page, source_file, display_page)], 'complete': bool}
+    # Archives expand to the entries they contain, each keyed by its own hash.
+    st.session_state.extracted_files = {}
 
 # Initialize Anthropic client with error handling
 # Try to get from Streamlit secrets first (for deployment)
@@ -57,139 +86,253 @@ except:
 if not api_key:
     st.error("⚠️ Service temporairement indisponible. Veuillez contacter l'administrateur.")
     st.info("💡 Pour assistance, contactez le support technique JABE.")
-    client = None
-else:
+
+@st.cache_resource
+def create_client(api_key):
+    from anthropic import Anthropic
+    return Anthropic(api_key=api_key)
+
+def get_client():
+    # Created on first extraction, then shared by all sessions of the process
+    if not api_key:
+        return None
     try:
-        client = Anthropic(api_key=api_key)
+        return create_client(api_key)
     except Exception as e:
         st.error("❌ Connexion au service impossible. Veuillez réessayer dans quelques instants.")
         st.info("🔄 Actualisez la page ou contactez le support si le problème persiste.")
-        client = None
+        return None
+
+@st.cache_resource
+def get_store():
+    # One durable result store per process, shared by all sessions
+    return open_store()
+
+# With OGAR_JOB_QUEUE=1, uploads are queued in the shared job store and
+# extracted by worker processes (see worker.py) instead of in this session
+JOB_QUEUE = os.getenv('OGAR_JOB_QUEUE', '0') == '1'
+JOB_POLL_INTERVAL = 1.0
+# Seconds a rerun follows a queued batch before handing control back
+JOB_WAIT_SECONDS = int(os.getenv('OGAR_JOB_WAIT_SECONDS', '60'))
+
+@st.cache_resource
+def get_jobs():
+    return open_jobs()
 
 def verify_password(password, hashed):
     return bcrypt.checkpw(password.encode('utf-8'), hashed)
 
-def encode_image(image):
-    buffered = io.BytesIO()
-    image.save(buffered, format="PNG")
-    return base64.b64encode(buffered.getvalue()).decode()
+def file_hash(uploaded_file):
+    # Hashed in place, getvalue() would copy the upload
+    with uploaded_file.getbuffer() as buffer:
+        return content_hash(buffer)
+
+def reset_extraction_state():
+    st.session_state.extracted_data = []
+    st.session_state.extracted_files = {}
+    st.session_state.pop('excel_export', None)
+    st.session_state.pop('pending_batch', None)
+    st.session_state.pop('estimates', None)
 
-def flatten_json_to_structured_format(data, parent_key='', parent_category=''):
+def sync_extracted_files(file_hashes):
     """
-    Flatten nested JSON and convert to structured format:
-    Column 1: Categorie (Main category)
-    Column 2: Nom du champ (Field name)
-    Column 3: Valeur du champ (Field value)
+    Keep only the results of files still present in the uploader and
+    rebuild the extracted_data references in upload order.
     """
-    items = []
-    
-    if isinstance(data, dict):
-        for key, value in data.items():
-            # Determine category
-            if not parent_category:
-                category = key.replace('_', ' ').title()
-            else:
-                category = parent_category
-            
-            if isinstance(value, dict):
-                # If it's a nested dict, recursively flatten
-                items.extend(flatten_json_to_structured_format(value, key, category))
-            elif isinstance(value, list):
-                # If it's a list, convert to string
-                items.append({
-                    'Categorie': category,
-                    'Nom du champ': key,
-                    'Valeur du champ': ', '.join(map(str, value)) if value else ''
-                })
-            else:
-                # Simple value
-                items.append({
-                    'Categorie': category,
-                    'Nom du champ': key,
-                    'Valeur du champ': str(value) if value is not None else ''
-                })
-    else:
-        items.append({
-            'Categorie': parent_category,
-            'Nom du champ': parent_key,
-            'Valeur du champ': str(data) if data is not None else ''
-        })
+    extracted_files = st.session_state.extracted_files
+    for key in list(extracted_files):
+        if key not in file_hashes:
+            del extracted_files[key]
     
-    return items
+    st.session_state.extracted_data = [
+        item
+        for key in file_hashes if key in extracted_files
+        for item in extracted_files[key]['items']
+    ]
 
-def extract_data_from_image(image, prompt="Extract all relevant fields and data from this document. Return as JSON."):
-    if not client:
-        return None
-        
-    base64_image = encode_image(image)
+def result_keys(refs):
+    # Distinct store keys of the given references, in display order
+    return list(dict.fromkeys(ref[0] for ref in refs))
+
+def wait_for_batch(stats):
+    """
+    Follow the queued batch of this session for up to JOB_WAIT_SECONDS.
+    Once its workers are done, record its results like an in-session
+    extraction and return True. Otherwise show where it stands and return
+    False: the batch is kept in session state, so that a rerun resumes
+    waiting for it.
+    """
+    batch = st.session_state.pending_batch
+    progress_bar = st.progress(0)
+    deadline = time.monotonic() + JOB_WAIT_SECONDS
+    with st.spinner("Traitement en cours par les serveurs d'extraction..."):
+        while True:
+            jobs = batch_jobs(get_jobs(), batch['id'])
+            finished = [job for job in jobs if job['status'] in FINISHED]
+            progress_bar.progress(len(finished) / len(jobs) if jobs else 1.0)
+            if len(finished) == len(jobs) or time.monotonic() >= deadline:
+                break
+            time.sleep(JOB_POLL_INTERVAL)
     
-    try:
-        response = client.messages.create(
-            model="claude-sonnet-4-5",
-            max_tokens=4096,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text", 
-                            "text": prompt
-                        },
-                        {
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": "image/png",
-                                "data": base64_image
-                            }
-                        }
-                    ]
-                }
-            ]
+    if len(finished) < len(jobs):
+        started = any(job['status'] != 'pending' for job in jobs)
+        st.info(
+            f"⏳ {len(finished)}/{len(jobs)} fichier(s) traité(s). "
+            + ("Le traitement continue sur les serveurs d'extraction." if started
+               else "Les fichiers sont en attente d'un serveur d'extraction.")
         )
-        
-        result = response.content[0].text
-        try:
-            # Try to parse as JSON
-            json_data = json.loads(result)
-            return json_data
-        except:
-            # If not valid JSON, try to extract JSON from markdown code blocks
-            if "```json" in result:
-                json_str = result.split("```json")[1].split("```")[0].strip()
-                return json.loads(json_str)
-            elif "```" in result:
-                json_str = result.split("```")[1].split("```")[0].strip()
-                return json.loads(json_str)
-            else:
-                return {"raw_text": result}
-    except Exception as e:
-        error_msg = str(e).lower()
-        if "rate" in error_msg and "limit" in error_msg:
-            st.error("⏱️ Trop de demandes simultanées. Veuillez patienter quelques secondes avant de réessayer.")
-            st.info("💡 Astuce: Traitez vos documents par petits groupes pour éviter ce message.")
-        elif "timeout" in error_msg:
-            st.error("⏰ Le traitement a pris trop de temps. Veuillez réessayer avec un document plus léger.")
-        elif "authentication" in error_msg or "unauthorized" in error_msg:
-            st.error("🔑 Accès non autorisé. Veuillez contacter votre administrateur.")
-        elif "network" in error_msg or "connection" in error_msg:
-            st.error("🌐 Problème de connexion internet. Vérifiez votre connexion et réessayez.")
+        st.button("🔄 Actualiser", key="refresh_batch")
+        return False
+    
+    for job in jobs:
+        key = batch['keys'][job['id']]
+        result = job['result']
+        if result is None:
+            report_extraction_error(RuntimeError(job['error'] or ''))
+            st.session_state.extracted_files[key] = {'items': [], 'complete': False}
+            continue
+        for error in result['errors']:
+            report_extraction_error(error_from_dict(error))
+        stats.update(result['stats'])
+        st.session_state.extracted_files[key] = {
+            'items': [tuple(item) for item in result['items']],
+            'complete': result['complete']
+        }
+    settle(get_store(), batch['user'], batch['estimate'], stats, batch['day'])
+    del st.session_state.pending_batch
+    return True
+
+def upload_estimate(key, file):
+    # Estimated once per uploaded content, the estimate reads PDF info and image headers
+    estimates = st.session_state.setdefault('estimates', {})
+    if key not in estimates:
+        estimates[key] = estimate_upload(file, file.name)
+    return estimates[key]
+
+def format_duration(seconds):
+    if seconds < 60:
+        return f"{seconds:.0f} s"
+    return f"{seconds / 60:.0f} min"
+
+def report_budget_exceeded(error):
+    if error.budget == 'batch':
+        st.error(f"💰 Ce lot dépasse le budget par lot ({error.limit:,} tokens pour {error.requested:,} estimés).")
+        st.info("💡 Astuce: Traitez vos documents par petits groupes.")
+    elif error.unit == 'tokens':
+        st.error(f"💰 Budget quotidien atteint: {error.used:,} tokens utilisés sur {error.limit:,}, ce lot en demande {error.requested:,}.")
+    else:
+        st.error(f"💰 Budget quotidien atteint: {error.used:.2f} $ dépensés sur {error.limit:.2f} $, ce lot est estimé à {error.requested:.2f} $.")
+
+def report_extraction_error(error):
+    """
+    Show a user-friendly message for an error raised while extracting a document.
+    """
+    if isinstance(error, DocumentReadError):
+        if is_archive_name(error.source_file):
+            st.error(f"🗜️ Impossible de lire l'archive {error.source_file}.")
+            st.info("💡 Vérifiez que l'archive n'est pas endommagée ou protégée par mot de passe.")
+        elif is_pdf_name(error.source_file):
+            st.error("📄 Impossible de lire le fichier PDF.")
+            st.info("💡 Assurez-vous que le fichier n'est pas protégé par mot de passe et qu'il n'est pas endommagé.")
         else:
-            st.error("❌ Impossible de traiter le document. Veuillez vérifier que le fichier est lisible et réessayer.")
-            if st.checkbox("Afficher les détails techniques", key=f"error_details_{id(e)}"):
-                st.code(f"Erreur technique: {str(e)}")
-        return None
+            st.error(f"🖼️ Impossible de lire l'image {error.source_file}.")
+        return
+    
+    error_msg = str(error).lower()
+    if "rate" in error_msg and "limit" in error_msg:
+        st.error("⏱️ Trop de demandes simultanées. Veuillez patienter quelques secondes avant de réessayer.")
+        st.info("💡 Astuce: Traitez vos documents par petits groupes pour éviter ce message.")
+    elif "timeout" in error_msg:
+        st.error("⏰ Le traitement a pris trop de temps. Veuillez réessayer avec un document plus léger.")
+    elif "authentication" in error_msg or "unauthorized" in error_msg:
+        st.error("🔑 Accès non autorisé. Veuillez contacter votre administrateur.")
+    elif "network" in error_msg or "connection" in error_msg:
+        st.error("🌐 Problème de connexion internet. Vérifiez votre connexion et réessayez.")
+    else:
+        st.error("❌ Impossible de traiter le document. Veuillez vérifier que le fichier est lisible et réessayer.")
+        if st.checkbox("Afficher les détails techniques", key=f"error_details_{id(error)}"):
+            st.code(f"Erreur technique: {str(error)}")
 
-def pdf_to_images(pdf_file):
-    images = []
-    try:
-        pdf_bytes = pdf_file.read()
-        images = pdf2image.convert_from_bytes(pdf_bytes, dpi=200)
-        return images
-    except Exception as e:
-        st.error("📄 Impossible de lire le fichier PDF.")
-        st.info("💡 Assurez-vous que le fichier n'est pas protégé par mot de passe et qu'il n'est pas endommagé.")
-        return []
+def fields_to_dataframe(rows):
+    """
+    Build the table view DataFrame from (file_hash, page, categorie, nom, valeur)
+    rows of the store, using the file names of the current session.
+    """
+    refs = {(key, page): (source_file, display_page)
+            for key, page, source_file, display_page in st.session_state.extracted_data}
+    with_pages = any(display_page for _, display_page in refs.values())
+    
+    categories, names, values, sources, pages = [], [], [], [], []
+    for key, page, categorie, nom, valeur in rows:
+        source_file, display_page = refs.get((key, page), ('Unknown', ''))
+        categories.append(categorie)
+        names.append(nom)
+        values.append(valeur)
+        sources.append(source_file)
+        pages.append(display_page)
+    
+    from exports import fields_frame
+    return fields_frame(categories, names, values, sources, pages if with_pages else None)
+
+def build_excel_export(store, file_hashes):
+    df = fields_to_dataframe(query_fields(store, file_hashes))
+    buffer = io.BytesIO()
+    from exports import write_excel
+    write_excel(df, buffer)
+    return buffer.getvalue()
+
+SEARCH_FIELDS = {
+    "Numéro de police": 'police_numero',
+    "Numéro de quittance": 'quittance_numero',
+    "Immatriculation": 'immatriculation',
+    "Châssis": 'chassis',
+    "Texte intégral": None
+}
+
+def search_page():
+    st.markdown("### 🔎 Recherche dans l'historique des extractions")
+    
+    col1, col2 = st.columns([1, 3])
+    with col1:
+        label = st.selectbox("Rechercher par", list(SEARCH_FIELDS), key="search_field")
+    with col2:
+        query = st.text_input("Valeur recherchée", key="search_query")
+    
+    if not query:
+        st.info("💡 Saisissez un numéro de police, de quittance, une immatriculation, un châssis ou tout autre texte.")
+        return
+    
+    store = get_store()
+    start = time.perf_counter()
+    results = search_documents(store, query, SEARCH_FIELDS[label])
+    elapsed = time.perf_counter() - start
+    
+    if not results:
+        st.warning("Aucun document trouvé.")
+        return
+    
+    import pandas as pd
+    st.caption(f"{len(results)} document(s) trouvé(s) en {elapsed * 1000:.0f} ms")
+    st.dataframe(pd.DataFrame([
+        {
+            'Fichier source': result['source_file'],
+            'Page': result['page'],
+            "Date d'extraction": result['created_at'][:19].replace('T', ' '),
+            'Police': result['police_numero'] or '',
+            'Quittance': result['quittance_numero'] or '',
+            'Immatriculation': result['immatriculation'] or '',
+            'Châssis': result['chassis'] or ''
+        }
+        for result in results
+    ]), use_container_width=True)
+    
+    selected = st.selectbox(
+        "Afficher le document",
+        range(len(results)),
+        format_func=lambda i: f"{results[i]['source_file']} - page {results[i]['page']}",
+        key="search_document"
+    )
+    st.json(load_document(store, results[selected]['file_hash'], results[selected]['page']))
 
 def signup_page():
     st.title("📝 Sign Up")
@@ -243,11 +386,9 @@ def main_app():
     # Sidebar with logo and user info
     with st.sidebar:
         # Display OGAR logo
-        try:
-            ogar_logo = Image.open("ogar_logo.png")
+        ogar_logo = load_logo("ogar_logo.png")
+        if ogar_logo:
             st.image(ogar_logo, use_column_width=True)
-        except:
-            pass
         
         st.markdown("---")
         st.title(f"👋 Bienvenue, {st.session_state.username}!")
@@ -276,17 +417,17 @@ def main_app():
         if st.button("🚪 Déconnexion", use_container_width=True, type="secondary"):
             st.session_state.logged_in = False
             st.session_state.username = None
-            st.session_state.extracted_data = []
+            reset_extraction_state()
             st.rerun()
     
     # Main content area
     # Header with logo and title
     col_logo, col_title = st.columns([1, 4])
     with col_logo:
-        try:
-            ogar_logo = Image.open("ogar_logo.png")
+        ogar_logo = load_logo("ogar_logo.png")
+        if ogar_logo:
             st.image(ogar_logo, width=100)
-        except:
+        else:
             st.markdown("# 🏢 OGAR")
     
     with col_title:
@@ -295,277 +436,231 @@ def main_app():
     
     st.markdown("---")
     
-    # Instructions section
-    with st.container():
-        st.markdown("### 📤 Téléchargez vos documents")
-        info_col1, info_col2, info_col3 = st.columns(3)
-        
-        with info_col1:
-            st.info("**📄 Formats acceptés**\nPDF, PNG, JPG, JPEG")
-        
-        with info_col2:
-            st.info("**🔄 Traitement**\nExtraction automatique de tous les champs")
-        
-        with info_col3:
-            st.info("**📊 Export Excel**\nDonnées structurées en 2 colonnes")
+    tab_extraction, tab_search = st.tabs(["📤 Extraction", "🔎 Recherche"])
     
-    st.markdown("---")
-    
-    # File upload section
-    uploaded_files = st.file_uploader(
-        "Glissez-déposez vos documents OGAR ou cliquez pour parcourir",
-        type=['png', 'jpg', 'jpeg', 'pdf'],
-        accept_multiple_files=True,
-        help="Téléchargez des images ou des fichiers PDF de vos documents d'assurance OGAR"
-    )
+    with tab_search:
+        search_page()
     
-    # Define the default prompt internally (hidden from user)
-    default_prompt = """Extrais TOUS les champs de ce document d'assurance OGAR en français.
-Retourne un objet JSON détaillé avec la structure suivante 
-
-(POINT D'ATTENTION !!! Les champs peuvent légèrement varier dans le nom/désignation/intitulé/description/etc. 
-Assure-toi de bien extraire tous les champs possibles où les libellées ont la même connotation/sens/signification:
-
-{
-  "informations_compagnie": {
-    "nom_compagnie": "",
-    "telephone": "",
-    "fax": "",
-    "bp": "",
-    "email": "",
-    "courtier": ""
-  },
-  "informations_police": {
-    "police_numero": "",
-    "quittance_numero": "",
-    "emission_date": "",
-    "effet_du": "",
-    "effet_heure": "",
-    "echeance_au": "",
-    "echeance_heure": "",
-    "compagnie": "",
-    "affaire": ""
-  },
-  "designation_vehicule": {
-    "marque": "",
-    "genre": "",
-    "type": "",
-    "carrosserie": "",
-    "energie": "",
-    "puissance": "",
-    "nombre_places": "",
-    "valeur_neuve": "",
-    "valeur_venale": "",
-    "mise_circulation": "",
-    "immatriculation": "",
-    "chassis": "",
-    "usage": ""
-  },
-  "souscripteur": {
-    "nom": "",
-    "numero_client": "",
-    "bp": "",
-    "ville": "",
-    "pays": "",
-    "telephone": "",
-    "fax": ""
-  },
-  "assure": {
-    "nom": "",
-    "bp": "",
-    "ville": "",
-    "pays": "",
-    "telephone": "",
-    "fax": ""
-  },
-  "garanties": {
-    "risque_a_responsabilite_civile": {"valeur": "", "franchise": "", "prime": ""},
-    "risque_b_recours_tiers_incendie": {"valeur": "", "franchise": "", "prime": ""},
-    "risque_c_defense_recours": {"valeur": "", "franchise": "", "prime": ""},
-    "risque_d_avance_recours": {"valeur": "", "franchise": "", "prime": ""},
-    "risque_e_incendie": {"valeur": "", "franchise": "", "prime": ""},
-    "risque_f_vol": {"valeur": "", "franchise": "", "prime": ""},
-    "risque_g_vol_agression": {"valeur": "", "franchise": "", "prime": ""},
-    "risque_h_bris_glace": {"valeur": "", "franchise": "", "prime": ""},
-    "risque_i_perte_totale": {"valeur": "", "franchise": "", "prime": ""},
-    "risque_j_tierce_collision": {"valeur": "", "franchise": "", "prime": ""},
-    "risque_k_dommages": {"valeur": "", "franchise": "", "prime": ""},
-    "risque_l_nombre_passagers": {"valeur": "", "franchise": "", "prime": ""},
-    "risque_m_pt_camion": {"valeur": "", "franchise": "", "prime": ""},
-    "risque_n_pt_eleves": {"valeur": "", "franchise": "", "prime": ""},
-    "risque_o_passagers_clandestins": {"valeur": "", "franchise": "", "prime": ""},
-    "risque_p_remorque": {"valeur": "", "franchise": "", "prime": ""},
-    "risque_q_individuelle_passagers": {"valeur": "", "franchise": "", "prime": ""},
-    "risque_r_assistance": {"valeur": "", "franchise": "", "prime": ""}
-  },
-  "tarif": {
-    "bonus": "",
-    "taux_pourcent": "",
-    "montant": "",
-    "stat_auto": "",
-    "stat_ip": ""
-  },
-  "capitaux_individuelle_passager": {
-    "deces": "",
-    "ipp": "",
-    "frais_medicaux": ""
-  },
-  "primes_detail": {
-    "prime_nette_brute": "",
-    "reductions": "",
-    "prime_nette_reduite_deduites": "",
-    "accessoires": "",
-    "taxes": "",
-    "cemac": "",
-    "css": "",
-    "tsvl": "",
-    "cca": "",
-    "prime_totale": ""
-  }
-}
-
-Extrais chaque champ visible dans le document. Si un champ est vide ou non visible, utilise une chaîne vide "". 
-Sois précis et exhaustif. N'oublie aucun champ.
-
-DANS LE CAS OU LES INTITULES DIFFERENT FAIT DES CORRESPONDANCES logiques entre les champs pour retrouver la valeur correspondante !!! 
-
-"""
-    
-    if uploaded_files:
-        if st.button("🚀 Extraire les données", type="primary", use_container_width=True):
-            progress_bar = st.progress(0)
-            st.session_state.extracted_data = []
+    with tab_extraction:
+        # Instructions section
+        with st.container():
+            st.markdown("### 📤 Téléchargez vos documents")
+            info_col1, info_col2, info_col3 = st.columns(3)
             
-            for idx, file in enumerate(uploaded_files):
-                progress_bar.progress((idx + 1) / len(uploaded_files))
-                
-                if file.type == "application/pdf":
-                    with st.spinner(f"Traitement de {file.name}..."):
-                        images = pdf_to_images(file)
-                        for img_idx, image in enumerate(images):
-                            data = extract_data_from_image(image, default_prompt)
-                            if data:
-                                data['source_file'] = file.name
-                                data['page'] = img_idx + 1
-                                st.session_state.extracted_data.append(data)
-                else:
-                    with st.spinner(f"Traitement de {file.name}..."):
-                        image = Image.open(file)
-                        data = extract_data_from_image(image, default_prompt)
-                        if data:
-                            data['source_file'] = file.name
-                            st.session_state.extracted_data.append(data)
+            with info_col1:
+                st.info("**📄 Formats acceptés**\nPDF, PNG, JPG, JPEG, ZIP, TAR")
             
-            st.success(f"✅ Données extraites de {len(uploaded_files)} fichier(s)!")
-    
-    if st.session_state.extracted_data:
+            with info_col2:
+                st.info("**🔄 Traitement**\nExtraction automatique de tous les champs")
+            
+            with info_col3:
+                st.info("**📊 Export Excel**\nDonnées structurées en 2 colonnes")
+        
         st.markdown("---")
-        st.markdown("### 📊 Données extraites")
         
-        tab1, tab2 = st.tabs(["Vue tableau", "Vue JSON"])
+        # File upload section
+        uploaded_files = st.file_uploader(
+            "Glissez-déposez vos documents OGAR ou cliquez pour parcourir",
+            type=['png', 'jpg', 'jpeg', 'pdf', 'zip', 'tar', 'tgz', 'gz'],
+            accept_multiple_files=True,
+            help="Téléchargez des images, des fichiers PDF ou des archives ZIP/TAR de vos documents d'assurance OGAR"
+        )
+        
+        # Files are keyed by content hash so that only new or changed uploads are
+        # processed, and removing a file from the uploader drops just its rows.
+        current_files = {}
+        for file in uploaded_files or []:
+            current_files.setdefault(file_hash(file), file)
+        sync_extracted_files(list(current_files))
         
-        with tab1:
-            # Convert data to table format
-            all_fields = []
-            for doc in st.session_state.extracted_data:
-                source_file = doc.get('source_file', 'Unknown')
-                page = doc.get('page', '')
-                
-                # Create a copy of doc without metadata
-                doc_copy = {k: v for k, v in doc.items() if k not in ['source_file', 'page']}
-                
-                # Flatten the JSON to structured format
-                flattened_data = flatten_json_to_structured_format(doc_copy)
+        if uploaded_files:
+            force_refresh = st.checkbox(
+                "🔄 Forcer une nouvelle extraction",
+                help="Ignore les extractions précédentes des mêmes documents (même contenu ou même numéro de quittance)",
+                key="force_refresh"
+            )
+            
+            pending = [
+                (key, file) for key, file in current_files.items()
+                if not st.session_state.extracted_files.get(key, {}).get('complete')
+            ]
+            # Upper bound: pages reused from earlier extractions are not charged
+            estimate = total(upload_estimate(key, file) for key, file in pending)
+            if estimate.pages:
+                st.caption(
+                    f"📐 Estimation: {estimate.pages} page(s), "
+                    f"{estimate.input_tokens + estimate.output_tokens:,} tokens, "
+                    f"{estimated_cost(estimate):.2f} $, environ {format_duration(estimated_seconds(estimate))}"
+                )
+            
+            stats = Counter()
+            extracted = 0
+            if st.button("🚀 Extraire les données", type="primary", use_container_width=True):
+                user = st.session_state.username
+                refused = None
+                if pending:
+                    try:
+                        day = admit(get_store(), user, estimate)
+                    except BudgetExceeded as e:
+                        refused = e
                 
-                # Add metadata to each field
-                for item in flattened_data:
-                    item['Fichier source'] = source_file
-                    if page:
-                        item['Page'] = page
-                    all_fields.append(item)
+                if not pending:
+                    st.info("ℹ️ Tous les documents ont déjà été traités.")
+                elif refused:
+                    report_budget_exceeded(refused)
+                elif JOB_QUEUE:
+                    batch_id, job_ids = enqueue_batch(
+                        get_jobs(), [(file.name, file) for _, file in pending], force_refresh
+                    )
+                    st.session_state.pending_batch = {
+                        'id': batch_id,
+                        'keys': dict(zip(job_ids, [key for key, _ in pending])),
+                        'files': len(pending),
+                        'user': user,
+                        'day': day,
+                        'estimate': estimate
+                    }
+                else:
+                    client = get_client()
+                    progress_bar = st.progress(0)
+                    
+                    try:
+                        for idx, (key, file) in enumerate(pending):
+                            progress_bar.progress((idx + 1) / len(pending))
+                            
+                            with st.spinner(f"Traitement de {file.name}..."):
+                                items, complete = process_upload(
+                                    client, get_store(), file, file.name, DEFAULT_PROMPT,
+                                    force_refresh=force_refresh,
+                                    on_error=report_extraction_error,
+                                    stats=stats
+                                )
+                            
+                            st.session_state.extracted_files[key] = {
+                                'items': items,
+                                'complete': complete
+                            }
+                    finally:
+                        # Settled even when an upload cannot be read, so that
+                        # its estimate does not stay reserved
+                        settle(get_store(), user, estimate, stats, day)
+                    extracted = len(pending)
             
-            if all_fields:
-                df = pd.DataFrame(all_fields)
-                # Reorder columns
-                cols = ['Categorie', 'Nom du champ', 'Valeur du champ', 'Fichier source']
-                if 'Page' in df.columns:
-                    cols.append('Page')
-                df = df[cols]
-                st.dataframe(df, use_container_width=True)
-        
-        with tab2:
-            st.json(st.session_state.extracted_data)
-        
-        col1, col2, col3 = st.columns([1, 1, 2])
+            if 'pending_batch' in st.session_state:
+                files = st.session_state.pending_batch['files']
+                if wait_for_batch(stats):
+                    extracted = files
+            
+            if extracted:
+                sync_extracted_files(list(current_files))
+                st.success(f"✅ Données extraites de {extracted} nouveau(x) fichier(s)!")
+                if stats['reused']:
+                    st.info(f"♻️ {stats['reused']} page(s) reprise(s) d'extractions précédentes.")
+                if stats['zonal']:
+                    st.info(f"🧩 {stats['zonal']} page(s) lue(s) localement grâce à un modèle de document connu.")
+                if stats['truncated']:
+                    st.info(f"✂️ {stats['truncated']} réponse(s) tronquée(s) complétée(s) par {stats['continuations']} requête(s) de suite.")
+                if stats['hedged']:
+                    st.info(f"⚡ {stats['hedged']} requête(s) lente(s) doublée(s), dont {stats['hedge_wins']} plus rapide(s) que l'originale.")
         
-        with col1:
-            # Convert extracted data to the desired format
-            all_fields = []
+        if st.session_state.extracted_data:
+            st.markdown("---")
+            st.markdown("### 📊 Données extraites")
             
-            for doc in st.session_state.extracted_data:
-                source_file = doc.get('source_file', 'Unknown')
-                page = doc.get('page', '')
-                
-                # Create a copy of doc without metadata
-                doc_copy = {k: v for k, v in doc.items() if k not in ['source_file', 'page']}
-                
-                # Flatten the JSON to structured format
-                flattened_data = flatten_json_to_structured_format(doc_copy)
-                
-                # Add metadata to each field
-                for item in flattened_data:
-                    item['Fichier source'] = source_file
-                    if page:
-                        item['Page'] = page
-                
-                all_fields.extend(flattened_data)
+            store = get_store()
+            file_hashes = result_keys(st.session_state.extracted_data)
             
-            if all_fields:
-                # Create DataFrame with proper column order
-                df = pd.DataFrame(all_fields)
-                cols = ['Categorie', 'Nom du champ', 'Valeur du champ', 'Fichier source']
-                if 'Page' in df.columns:
-                    cols.append('Page')
-                df = df[cols]
+            tab1, tab2 = st.tabs(["Vue tableau", "Vue JSON"])
+            
+            with tab1:
+                # Filtering and pagination are done in the store, only the
+                # current page of rows is loaded
+                filter_col1, filter_col2, filter_col3 = st.columns([2, 2, 1])
+                with filter_col1:
+                    search = st.text_input("🔎 Filtrer les champs", key="table_search")
+                with filter_col2:
+                    categorie = st.selectbox(
+                        "Catégorie",
+                        ["Toutes"] + list_categories(store, file_hashes),
+                        key="table_category"
+                    )
+                with filter_col3:
+                    page_size = st.selectbox("Lignes par page", [50, 100, 250, 500], key="table_page_size")
                 
-                buffer = io.BytesIO()
+                if categorie == "Toutes":
+                    categorie = None
                 
-                with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                    # First worksheet: Structured data
-                    df.to_excel(writer, sheet_name='Données OGAR', index=False)
-                    
-                    # Auto-adjust column widths for first worksheet
-                    worksheet = writer.sheets['Données OGAR']
-                    for idx, col in enumerate(df.columns):
-                        max_length = max(
-                            df[col].astype(str).apply(len).max(),
-                            len(col)
-                        )
-                        worksheet.column_dimensions[chr(65 + idx)].width = min(max_length + 2, 50)
+                field_total = count_fields(store, file_hashes, search, categorie)
+                page_count = max(1, -(-field_total // page_size))
+                if st.session_state.get('table_page', 1) > page_count:
+                    st.session_state.table_page = page_count
+                table_page = st.number_input(
+                    f"Page (sur {page_count})",
+                    min_value=1,
+                    max_value=page_count,
+                    value=1,
+                    step=1,
+                    key="table_page"
+                )
                 
-                st.download_button(
-                    label="📥 Télécharger le fichier Excel",
-                    data=buffer.getvalue(),
-                    file_name=f"ogar_extraction_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                    type="primary",
-                    use_container_width=True
+                rows = query_fields(
+                    store, file_hashes, search, categorie,
+                    limit=page_size, offset=(table_page - 1) * page_size
                 )
-        
-        with col2:
-            if st.button("🗑️ Effacer les données", use_container_width=True):
-                st.session_state.extracted_data = []
-                st.rerun()
+                if rows:
+                    st.dataframe(fields_to_dataframe(rows), use_container_width=True)
+                    st.caption(f"{field_total} champ(s) au total")
+                else:
+                    st.info("Aucun champ ne correspond au filtre.")
+            
+            with tab2:
+                # Load a single document from the store on demand
+                refs = st.session_state.extracted_data
+                selected = st.selectbox(
+                    "Document",
+                    range(len(refs)),
+                    format_func=lambda i: f"{refs[i][2]} - page {refs[i][3]}" if refs[i][3] else refs[i][2],
+                    key="json_document"
+                )
+                key, page, _, _ = refs[selected]
+                st.json(load_document(store, key, page))
+            
+            col1, col2, col3 = st.columns([1, 1, 2])
+            
+            with col1:
+                # The Excel file is only built on request, not on every rerun
+                export_refs = tuple(st.session_state.extracted_data)
+                export = st.session_state.get('excel_export')
+                if export is None or export['refs'] != export_refs:
+                    if st.button("📄 Préparer le fichier Excel", use_container_width=True):
+                        with st.spinner("Préparation de l'export..."):
+                            st.session_state.excel_export = {
+                                'refs': export_refs,
+                                'data': build_excel_export(store, file_hashes)
+                            }
+                        st.rerun()
+                else:
+                    st.download_button(
+                        label="📥 Télécharger le fichier Excel",
+                        data=export['data'],
+                        file_name=f"ogar_extraction_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                        type="primary",
+                        use_container_width=True
+                    )
+            
+            with col2:
+                if st.button("🗑️ Effacer les données", use_container_width=True):
+                    reset_extraction_state()
+                    st.rerun()
     
     # Add JABE logo at bottom right of main page
     st.markdown("<br><br>", unsafe_allow_html=True)
     _, _, _, col_jabe_bottom = st.columns([3, 1, 1, 1])
     with col_jabe_bottom:
-        try:
-            jabe_logo = Image.open("JABE_LOGO.jpg")
+        jabe_logo = load_logo("JABE_LOGO.jpg")
+        if jabe_logo:
             st.image(jabe_logo, width=80)
-        except:
-            pass
 
 def main():
     if 'page' not in st.session_state:
@@ -575,10 +670,10 @@ def main():
         col1, col2, col3 = st.columns([1, 2, 1])
         with col2:
             # Display OGAR logo at the top of login/signup page
-            try:
-                ogar_logo = Image.open("ogar_logo.png")
+            ogar_logo = load_logo("ogar_logo.png")
+            if ogar_logo:
                 st.image(ogar_logo, use_column_width=True)
-            except:
+            else:
                 st.markdown("# 🏢 OGAR")
             
             st.markdown("---")
@@ -597,11 +692,9 @@ def main():
             st.markdown("<br><br>", unsafe_allow_html=True)
             _, _, col_jabe = st.columns([2, 1, 1])
             with col_jabe:
-                try:
-                    jabe_logo = Image.open("JABE_LOGO.jpg")
+                jabe_logo = load_logo("JABE_LOGO.jpg")
+                if jabe_logo:
                     st.image(jabe_logo, width=80)
-                except:
-                    pass
     else:
         main_app()
 
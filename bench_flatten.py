@@ -0,0 +1,133 @@
+"""
+Flattening microbenchmark.
+
+Builds a large synthetic result set (every schema field filled, with list
+values mixed in) and times turning it into the fields DataFrame:
+- recursive: the former flatten_json_to_structured_format, one dict per
+  field, then a DataFrame from the list of dicts;
+- columnar: schema.flatten_columns appending straight into column lists,
+  then exports.fields_frame;
+- memoized: store.load_record on documents already loaded once, as for
+  repeated exports and API polls.
+
+Run with:
+    python bench_flatten.py --documents 2000
+
+Keep --documents within store.RECORD_CACHE_SIZE for the memoized variant.
+"""
+import argparse
+import copy
+import os
+import random
+import tempfile
+import time
+
+import pandas as pd
+
+from exports import fields_frame, records_frame
+from schema import RESULT_TEMPLATE, SCHEMA, flatten_columns
+from store import load_record, open_store, save_page_result
+
+def recursive_flatten(data, parent_key='', parent_category=''):
+    # flatten_json_to_structured_format before the columnar engine
+    items = []
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if not parent_category:
+                category = key.replace('_', ' ').title()
+            else:
+                category = parent_category
+            if isinstance(value, dict):
+                items.extend(recursive_flatten(value, key, category))
+            elif isinstance(value, list):
+                items.append({
+                    'Categorie': category,
+                    'Nom du champ': key,
+                    'Valeur du champ': ', '.join(map(str, value)) if value else ''
+                })
+            else:
+                items.append({
+                    'Categorie': category,
+                    'Nom du champ': key,
+                    'Valeur du champ': str(value) if value is not None else ''
+                })
+    else:
+        items.append({
+            'Categorie': parent_category,
+            'Nom du champ': parent_key,
+            'Valeur du champ': str(data) if data is not None else ''
+        })
+    return items
+
+def synthetic_document(rng):
+    data = copy.deepcopy(RESULT_TEMPLATE)
+    for field in SCHEMA:
+        *parents, name = field.path.split('.')
+        target = data
+        for parent in parents:
+            target = target[parent]
+        if rng.random() < 0.1:
+            target[name] = [rng.randint(0, 10 ** 6) for _ in range(3)]
+        else:
+            target[name] = f"{name}-{rng.randint(0, 10 ** 9)}"
+    return data
+
+def timed(function, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Time result flattening into the fields DataFrame.")
+    parser.add_argument("--documents", type=int, default=2000, help="Synthetic documents")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per variant, best is kept")
+    args = parser.parse_args()
+    
+    rng = random.Random(0)
+    documents = [synthetic_document(rng) for _ in range(args.documents)]
+    sources = [f"document_{i}.pdf" for i in range(args.documents)]
+    
+    def recursive():
+        rows = []
+        for source, data in zip(sources, documents):
+            for row in recursive_flatten(data):
+                row['Fichier source'] = source
+                rows.append(row)
+        return pd.DataFrame(rows)
+    
+    def columnar():
+        columns = ([], [], [])
+        source_column = []
+        for source, data in zip(sources, documents):
+            flatten_columns(data, columns)
+            source_column.extend([source] * (len(columns[0]) - len(source_column)))
+        return fields_frame(*columns, source_column)
+    
+    with tempfile.TemporaryDirectory() as directory:
+        store = open_store(os.path.join(directory, 'bench.db'))
+        for i, data in enumerate(documents):
+            save_page_result(store, f"hash{i}", 1, data, sources[i])
+        refs = [(f"hash{i}", 1, sources[i]) for i in range(args.documents)]
+        
+        def memoized():
+            return records_frame([
+                (source, 1, load_record(store, key, page)) for key, page, source in refs
+            ])
+        
+        memoized()  # first pass loads and memoizes the records
+        rows = args.documents * len(SCHEMA)
+        baseline = timed(recursive, args.repeat)
+        print(f"{args.documents} documents, {rows} fields")
+        for label, seconds in [
+            ("recursive", baseline),
+            ("columnar", timed(columnar, args.repeat)),
+            ("memoized records", timed(memoized, args.repeat))
+        ]:
+            print(f"{label:<18} {seconds * 1000:9.1f} ms   x{baseline / seconds:5.2f}")
+        store.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Startup and rerun timing of the Streamlit app.
+
+Runs app.py with Streamlit's AppTest harness and reports:
+- cold start: first run up to the login page, in a fresh interpreter each
+  time, so that module imports and process-wide caches are included;
+- rerun latency of the login page and of the logged-in extraction page,
+  i.e. the cost of each interaction once the process is warm.
+
+Run with:
+    python bench_startup.py --cold-runs 5 --reruns 20
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+COLD_RUN = """
+import time
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+app = AppTest.from_file("app.py", default_timeout=120)
+app.run()
+assert not app.exception, app.exception
+print(time.perf_counter() - start)
+"""
+
+def cold_start(runs):
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", COLD_RUN], cwd=APP_DIR, check=True,
+            capture_output=True, text=True
+        ).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+    return timings
+
+def rerun_timings(app, reruns):
+    timings = []
+    for _ in range(reruns):
+        start = time.perf_counter()
+        app.run()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def report(label, timings):
+    print(f"{label:<28} median {statistics.median(timings) * 1000:8.1f} ms"
+          f"   min {min(timings) * 1000:8.1f} ms   ({len(timings)} runs)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the app's cold start and reruns.")
+    parser.add_argument("--cold-runs", type=int, default=5, help="Fresh interpreters started")
+    parser.add_argument("--reruns", type=int, default=20, help="Reruns timed per page")
+    args = parser.parse_args()
+
+    from streamlit.testing.v1 import AppTest
+
+    report("Cold start (login page)", cold_start(args.cold_runs))
+
+    os.chdir(APP_DIR)
+    app = AppTest.from_file("app.py", default_timeout=120)
+    app.run()
+    report("Rerun, login page", rerun_timings(app, args.reruns))
+
+    app.session_state["logged_in"] = True
+    app.session_state["username"] = "bench"
+    app.run()
+    report("Rerun, extraction page", rerun_timings(app, args.reruns))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Token and cost budgets.
+
+Before a batch is extracted, its input tokens are estimated page by page
+from the image size the model will see and the prompt size, without
+rendering anything: PDF page sizes come from the PDF info, image sizes from
+their header, both read from the spooled upload (see
+extraction.iter_documents). The estimate gives the cost and duration shown
+before extraction starts, and is checked against the configured budgets:
+
+- OGAR_BATCH_TOKEN_BUDGET: tokens for a single batch;
+- OGAR_USER_DAILY_TOKEN_BUDGET and OGAR_USER_DAILY_COST_BUDGET: tokens and
+  cost (in dollars) per user and per day, kept in the result store.
+
+A batch within budget reserves its estimate; once it is done, the
+reservation is settled against the tokens actually used, so pages reused
+from earlier extractions are given back. A batch over budget is refused.
+A budget left at 0 is not enforced.
+"""
+import os
+from collections import namedtuple
+from contextlib import closing
+from datetime import date
+
+from extraction import (
+    COMPACT_OUTPUT, DEFAULT_PROMPT, DPI_LADDER, EXTRACTION_WORKERS, MAX_CONCURRENT_REQUESTS,
+    MAX_IMAGE_EDGE, REQUESTS_PER_MINUTE, DocumentReadError, is_pdf_name, iter_documents,
+    open_image, pdf_info, pdf_page_pixels
+)
+from schema import COMPACT_PROMPT
+from store import add_usage, reserve_usage
+
+BATCH_TOKEN_BUDGET = int(os.getenv('OGAR_BATCH_TOKEN_BUDGET', '0'))
+USER_DAILY_TOKEN_BUDGET = int(os.getenv('OGAR_USER_DAILY_TOKEN_BUDGET', '0'))
+USER_DAILY_COST_BUDGET = float(os.getenv('OGAR_USER_DAILY_COST_BUDGET', '0'))
+
+# Model prices, in dollars per million tokens
+INPUT_PRICE_PER_MTOK = float(os.getenv('OGAR_INPUT_PRICE_PER_MTOK', '3'))
+OUTPUT_PRICE_PER_MTOK = float(os.getenv('OGAR_OUTPUT_PRICE_PER_MTOK', '15'))
+
+# Typical response size with the full template and in compact mode
+OUTPUT_TOKENS_PER_PAGE = 600 if COMPACT_OUTPUT else 2500
+# Typical duration of a model call
+SECONDS_PER_PAGE = float(os.getenv('OGAR_SECONDS_PER_PAGE', '20'))
+
+# The model sees images downscaled to this long edge and pixel count, and
+# counts about one token per 750 pixels
+MODEL_IMAGE_EDGE = 1568
+MODEL_IMAGE_PIXELS = 1_150_000
+PIXELS_PER_TOKEN = 750
+# Rough characters per token of the French prompts
+CHARS_PER_TOKEN = 3.5
+
+Estimate = namedtuple('Estimate', ['pages', 'input_tokens', 'output_tokens'])
+
+class BudgetExceeded(Exception):
+    """
+    Raised when a batch would go over a budget. budget is 'batch' or
+    'daily', limit and used are in the budget's unit (tokens or dollars).
+    """
+    def __init__(self, budget, unit, limit, used, requested):
+        super().__init__(f"{budget} {unit} budget exceeded: {used} used + {requested} requested > {limit}")
+        self.budget = budget
+        self.unit = unit
+        self.limit = limit
+        self.used = used
+        self.requested = requested
+
+def image_tokens(width, height):
+    scale = min(1.0, MODEL_IMAGE_EDGE / max(width, height), (MODEL_IMAGE_PIXELS / (width * height)) ** 0.5)
+    return int(width * scale * height * scale / PIXELS_PER_TOKEN) + 1
+
+def page_tokens(width, height, prompt=DEFAULT_PROMPT):
+    if COMPACT_OUTPUT and prompt == DEFAULT_PROMPT:
+        prompt = COMPACT_PROMPT
+    return image_tokens(width, height) + int(len(prompt) / CHARS_PER_TOKEN)
+
+def estimate_document(path, name, prompt=DEFAULT_PROMPT):
+    """
+    Estimate a single PDF or image file, assuming every page is sent to the model.
+    """
+    if is_pdf_name(name):
+        info = pdf_info(path, name)
+        pages = int(info.get("Pages", 0))
+        width, height = pdf_page_pixels(info, DPI_LADDER[0])
+    else:
+        pages = 1
+        with open_image(path, name) as image:
+            width, height = image.size
+        if max(width, height) > MAX_IMAGE_EDGE:
+            width, height = (side * MAX_IMAGE_EDGE / max(width, height) for side in (width, height))
+    return Estimate(pages, pages * page_tokens(width, height, prompt), pages * OUTPUT_TOKENS_PER_PAGE)
+
+def estimate_upload(fileobj, name, prompt=DEFAULT_PROMPT):
+    """
+    Estimate an uploaded file, archives entry by entry. Unreadable files
+    count for nothing, their error is reported when they are processed.
+    """
+    estimates = []
+    try:
+        with closing(iter_documents(fileobj, name)) as documents:
+            for path, _, source_file in documents:
+                try:
+                    estimates.append(estimate_document(path, source_file, prompt))
+                except DocumentReadError:
+                    pass
+    except DocumentReadError:
+        pass
+    return total(estimates)
+
+def total(estimates):
+    return Estimate(*(sum(values) for values in zip(Estimate(0, 0, 0), *estimates)))
+
+def tokens_of(estimate):
+    return estimate.input_tokens + estimate.output_tokens
+
+def cost_of(input_tokens, output_tokens):
+    return (input_tokens * INPUT_PRICE_PER_MTOK + output_tokens * OUTPUT_PRICE_PER_MTOK) / 1_000_000
+
+def estimated_cost(estimate):
+    return cost_of(estimate.input_tokens, estimate.output_tokens)
+
+def estimated_seconds(estimate):
+    # Calls run EXTRACTION_WORKERS or MAX_CONCURRENT_REQUESTS at a time,
+    # and start at most REQUESTS_PER_MINUTE times per minute
+    concurrency = max(1, min(EXTRACTION_WORKERS, MAX_CONCURRENT_REQUESTS))
+    seconds = estimate.pages * SECONDS_PER_PAGE / concurrency
+    if REQUESTS_PER_MINUTE:
+        seconds = max(seconds, estimate.pages * 60 / REQUESTS_PER_MINUTE)
+    return seconds
+
+def admit(store, user, estimate, day=None):
+    """
+    Check a batch against the budgets and reserve its estimate on the
+    user's day. Raises BudgetExceeded when it does not fit.
+    """
+    day = day or date.today().isoformat()
+    tokens = tokens_of(estimate)
+    cost = estimated_cost(estimate)
+    if BATCH_TOKEN_BUDGET and tokens > BATCH_TOKEN_BUDGET:
+        raise BudgetExceeded('batch', 'tokens', BATCH_TOKEN_BUDGET, 0, tokens)
+    
+    reserved, used_tokens, used_cost = reserve_usage(
+        store, user, day, tokens, cost, USER_DAILY_TOKEN_BUDGET, USER_DAILY_COST_BUDGET
+    )
+    if not reserved:
+        if USER_DAILY_TOKEN_BUDGET and used_tokens + tokens > USER_DAILY_TOKEN_BUDGET:
+            raise BudgetExceeded('daily', 'tokens', USER_DAILY_TOKEN_BUDGET, used_tokens, tokens)
+        raise BudgetExceeded('daily', 'cost', USER_DAILY_COST_BUDGET, round(used_cost, 2), round(cost, 2))
+    return day
+
+def settle(store, user, estimate, stats, day=None):
+    """
+    Replace a batch's reservation with the tokens it actually used, as
+    counted in its stats.
+    """
+    day = day or date.today().isoformat()
+    input_tokens, output_tokens = stats.get('input_tokens', 0), stats.get('output_tokens', 0)
+    add_usage(
+        store, user, day,
+        input_tokens + output_tokens - tokens_of(estimate),
+        cost_of(input_tokens, output_tokens) - estimated_cost(estimate)
+    )
@@ -0,0 +1,54 @@
+"""
+Table and Excel export of extracted fields, shared by the Streamlit app and
+the watch-folder daemon.
+"""
+import pandas as pd
+
+SHEET_NAME = 'Données OGAR'
+
+def fields_frame(categories, names, values, sources, pages=None):
+    """
+    Build the fields DataFrame column by column. Label columns repeat a few
+    distinct strings over every row and are stored as categoricals.
+    """
+    columns = {
+        'Categorie': pd.Categorical(categories),
+        'Nom du champ': pd.Categorical(names),
+        'Valeur du champ': values,
+        'Fichier source': pd.Categorical(sources)
+    }
+    if pages is not None:
+        columns['Page'] = pages
+    return pd.DataFrame(columns)
+
+def records_frame(documents):
+    """
+    Build the fields DataFrame of (source_file, display_page, Record) documents.
+    """
+    categories, names, values, sources, pages = [], [], [], [], []
+    for source_file, display_page, record in documents:
+        record_categories, record_names, record_values = record.columns()
+        categories.extend(record_categories)
+        names.extend(record_names)
+        values.extend(record_values)
+        sources.extend([source_file] * len(record_values))
+        pages.extend([display_page] * len(record_values))
+    return fields_frame(categories, names, values, sources, pages)
+
+def write_excel(df, target):
+    """
+    Write the fields DataFrame to target (a path or a binary buffer) with
+    column widths adjusted to their content.
+    """
+    with pd.ExcelWriter(target, engine='openpyxl') as writer:
+        # First worksheet: Structured data
+        df.to_excel(writer, sheet_name=SHEET_NAME, index=False)
+        
+        # Auto-adjust column widths for first worksheet
+        worksheet = writer.sheets[SHEET_NAME]
+        for idx, col in enumerate(df.columns):
+            max_length = max(
+                df[col].astype(str).apply(len).max() if len(df) else 0,
+                len(col)
+            )
+            worksheet.column_dimensions[chr(65 + idx)].width = min(max_length + 2, 50)
@@ -0,0 +1,809 @@
+"""
+Document extraction pipeline.
+
+Shared by the Streamlit app and the HTTP API: PDF rendering, model calls,
+response parsing and flattening, and the checkpointed, cached processing of
+uploaded files against the result store. Nothing here depends on Streamlit:
+errors are raised, or passed to an on_error callback while a batch carries
+on, so that each front end can present them its own way.
+"""
+import base64
+import hashlib
+import io
+import json
+import logging
+import mmap
+import os
+import queue
+import re
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from collections import Counter, defaultdict, deque
+from contextlib import closing, contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from PIL import Image
+
+from schema import COMPACT_PROMPT, DEFAULT_PROMPT, RESULT_TEMPLATE, expand_compact, flatten_columns
+from store import (
+    save_page_result, completed_pages, find_by_page_hash,
+    find_by_business_keys, has_business_keys
+)
+from templates import learn_template, zonal_extract
+
+logger = logging.getLogger(__name__)
+
+MODEL = "claude-sonnet-4-5"
+
+DOCUMENT_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.pdf')
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tgz', '.gz')
+
+class DocumentReadError(Exception):
+    """
+    Raised when an uploaded PDF, image or archive cannot be read.
+    """
+    def __init__(self, source_file, message=None):
+        super().__init__(message or f"Cannot read {source_file}")
+        self.source_file = source_file
+
+def error_to_dict(error):
+    """
+    Serializable form of an error reported while extracting, for results
+    produced by another process (see worker.py).
+    """
+    if isinstance(error, DocumentReadError):
+        return {'message': str(error), 'source_file': error.source_file}
+    return {'message': str(error)}
+
+def error_from_dict(info):
+    if 'source_file' in info:
+        return DocumentReadError(info['source_file'], info['message'])
+    return RuntimeError(info['message'])
+
+class RateLimiter:
+    """
+    Process-wide limit on model calls, shared by every session and request:
+    at most max_concurrent calls in flight, started at most
+    requests_per_minute times per minute.
+    """
+    def __init__(self, max_concurrent, requests_per_minute):
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+        self._interval = 60.0 / requests_per_minute if requests_per_minute else 0
+        self._lock = threading.Lock()
+        self._next_start = 0.0
+    
+    def __enter__(self):
+        self._semaphore.acquire()
+        if self._interval:
+            with self._lock:
+                now = time.monotonic()
+                start = max(now, self._next_start)
+                self._next_start = start + self._interval
+            if start > now:
+                time.sleep(start - now)
+        return self
+    
+    def __exit__(self, *exc_info):
+        self._semaphore.release()
+        return False
+
+class Hedger:
+    """
+    Hedging of slow model calls: when a call has not completed after the
+    given percentile of recent call latencies, a duplicate request is sent,
+    the first response wins and the other request is cancelled. Hedges are
+    capped to max_ratio of all calls, which bounds the extra spend.
+    Latencies are kept per kind of call, as a short identification request
+    and a full extraction do not take the same time.
+    """
+    def __init__(self, percentile, max_ratio, window=200, min_samples=20, max_workers=64):
+        self.percentile = percentile
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self._latencies = defaultdict(lambda: deque(maxlen=window))
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._hedges = 0
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+    
+    def delay(self, kind=None):
+        # Latency after which a call of this kind is hedged, None while
+        # still learning
+        with self._lock:
+            latencies = self._latencies.get(kind, ())
+            if len(latencies) < self.min_samples:
+                return None
+            ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))]
+    
+    def _timed(self, attempt, cancelled, kind):
+        start = time.monotonic()
+        response = attempt(cancelled)
+        if response is not None:
+            # Cancelled attempts were cut short, their latency would drag
+            # the percentile down
+            with self._lock:
+                self._latencies[kind].append(time.monotonic() - start)
+        return response
+    
+    def _may_hedge(self):
+        with self._lock:
+            if self._hedges + 1 > self.max_ratio * self._calls:
+                return False
+            self._hedges += 1
+            return True
+    
+    def call(self, attempt, stats=None, kind=None):
+        """
+        Run attempt(cancelled), a function making one request that returns
+        its response, or None once the cancelled event is set. kind groups
+        the calls whose latencies are comparable. Returns
+        (response, requests), requests being the number of requests sent
+        that did not fail, including a cancelled loser. Hedges are counted
+        in stats['hedged'], and those answering first in stats['hedge_wins'].
+        """
+        with self._lock:
+            self._calls += 1
+        delay = self.delay(kind)
+        if delay is None:
+            return self._timed(attempt, threading.Event(), kind), 1
+        
+        primary_cancelled = threading.Event()
+        primary = self._pool.submit(self._timed, attempt, primary_cancelled, kind)
+        try:
+            return primary.result(timeout=delay), 1
+        except FutureTimeoutError:
+            if not self._may_hedge():
+                return primary.result(), 1
+        if stats is not None:
+            stats['hedged'] += 1
+        hedge_cancelled = threading.Event()
+        hedge = self._pool.submit(self._timed, attempt, hedge_cancelled, kind)
+        events = {primary: primary_cancelled, hedge: hedge_cancelled}
+        
+        # First successful response wins, an error only counts once both failed
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for other in pending:
+                        events[other].set()
+                    if future is hedge and stats is not None:
+                        stats['hedge_wins'] += 1
+                    other = hedge if future is primary else primary
+                    requests = 1 if other.done() and other.exception() is not None else 2
+                    return future.result(), requests
+        return primary.result(), 1
+
+# PDF pages are rendered by RASTER_WORKERS poppler processes running in
+# parallel, and flow through a queue of at most PAGE_QUEUE_SIZE rendered
+# pages to EXTRACTION_WORKERS threads calling the model, so that rendering
+# overlaps with network time.
+RASTER_WORKERS = int(os.getenv('OGAR_RASTER_WORKERS', str(os.cpu_count() or 2)))
+EXTRACTION_WORKERS = int(os.getenv('OGAR_EXTRACTION_WORKERS', '4'))
+PAGE_QUEUE_SIZE = int(os.getenv('OGAR_PAGE_QUEUE_SIZE', '8'))
+
+# Uploads are spooled to temporary files in OGAR_SPOOL_DIR (the system
+# temporary directory by default) and processed from there, so that no
+# document is held in memory whole. Rendered pages are the remaining large
+# allocations: with OGAR_MEMORY_LIMIT_MB set, the stages above are narrowed
+# so that the pages in flight fit within it (see pipeline_sizes), down to
+# one page per stage. 0 leaves them as configured.
+SPOOL_DIR = os.getenv('OGAR_SPOOL_DIR') or None
+SPOOL_CHUNK_SIZE = 1024 * 1024
+MEMORY_LIMIT_MB = int(os.getenv('OGAR_MEMORY_LIMIT_MB', '1024'))
+
+# PDF pages are first rendered at the lowest resolution of the ladder, and
+# re-rendered at the next one only when the extraction fails validation
+# (see needs_higher_resolution), e.g. OGAR_DPI_LADDER=100,150,200. The
+# default single step renders every page at 200 dpi.
+DPI_LADDER = tuple(int(dpi) for dpi in os.getenv('OGAR_DPI_LADDER', '200').split(','))
+
+# With OGAR_COMPACT_OUTPUT=1, requests made with the default prompt ask for
+# the non-empty fields only, keyed by short codes (see schema.COMPACT_PROMPT),
+# and the response is expanded back to the full structure
+COMPACT_OUTPUT = os.getenv('OGAR_COMPACT_OUTPUT', '0') == '1'
+COMPACT_MAX_TOKENS = 2048
+
+# Uploaded images in a format the model accepts, within MAX_IMAGE_BYTES
+# (the API takes 5 MB once base64 encoded) and MAX_IMAGE_EDGE pixels, are
+# sent as uploaded; larger ones are downscaled to DOWNSCALE_IMAGE_EDGE
+MEDIA_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'GIF': 'image/gif', 'WEBP': 'image/webp'}
+MAX_IMAGE_BYTES = 3_750_000
+MAX_IMAGE_EDGE = int(os.getenv('OGAR_MAX_IMAGE_EDGE', '4096'))
+DOWNSCALE_IMAGE_EDGE = 2048
+
+# Continuation requests made for a response cut off by max_tokens
+MAX_CONTINUATIONS = int(os.getenv('OGAR_MAX_CONTINUATIONS', '2'))
+
+MAX_CONCURRENT_REQUESTS = int(os.getenv('OGAR_MAX_CONCURRENT_REQUESTS', '4'))
+REQUESTS_PER_MINUTE = int(os.getenv('OGAR_REQUESTS_PER_MINUTE', '50'))
+rate_limiter = RateLimiter(MAX_CONCURRENT_REQUESTS, REQUESTS_PER_MINUTE)
+
+# Request hedging is enabled by setting OGAR_HEDGE_PERCENTILE, e.g. 95 to
+# hedge the calls slower than 95% of recent ones, with at most
+# OGAR_HEDGE_MAX_RATIO extra requests per call
+HEDGE_PERCENTILE = float(os.getenv('OGAR_HEDGE_PERCENTILE', '0'))
+hedger = Hedger(
+    HEDGE_PERCENTILE, float(os.getenv('OGAR_HEDGE_MAX_RATIO', '0.05'))
+) if HEDGE_PERCENTILE else None
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def image_hash(image):
+    return content_hash(image.tobytes())
+
+def encode_image(image, format="PNG"):
+    buffered = io.BytesIO()
+    image.save(buffered, format=format)
+    return base64.b64encode(buffered.getvalue()).decode()
+
+@contextmanager
+def spooled(fileobj, name):
+    """
+    Copy a file object to a temporary file, chunk by chunk, hashing it on
+    the way. Yields (path, content hash); the file is deleted on exit.
+    """
+    digest = hashlib.sha256()
+    fd, path = tempfile.mkstemp(suffix=os.path.splitext(name)[1], prefix='ogar-', dir=SPOOL_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as spool_file:
+            for chunk in iter(lambda: fileobj.read(SPOOL_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                spool_file.write(chunk)
+        yield path, digest.hexdigest()
+    finally:
+        os.unlink(path)
+
+def is_pdf_name(name):
+    return name.lower().endswith('.pdf')
+
+def is_archive_name(name):
+    return name.lower().endswith(ARCHIVE_EXTENSIONS)
+
+def flatten_json_to_structured_format(data):
+    """
+    Flatten nested JSON and convert to structured format:
+    Column 1: Categorie (Main category)
+    Column 2: Nom du champ (Field name)
+    Column 3: Valeur du champ (Field value)
+    """
+    return [
+        {'Categorie': categorie, 'Nom du champ': nom, 'Valeur du champ': valeur}
+        for categorie, nom, valeur in zip(*flatten_columns(data))
+    ]
+
+def parse_response_text(result):
+    try:
+        # Try to parse as JSON
+        return json.loads(result)
+    except ValueError:
+        # If not valid JSON, try to extract JSON from markdown code blocks
+        if "```json" in result:
+            json_str = result.split("```json")[1].split("```")[0].strip()
+            return json.loads(json_str)
+        elif "```" in result:
+            json_str = result.split("```")[1].split("```")[0].strip()
+            return json.loads(json_str)
+        else:
+            return {"raw_text": result}
+
+def _request(client, max_tokens, messages, cancelled=None):
+    """
+    Make one model call. Hedged calls are streamed so that the losing
+    request can be cancelled by closing its connection; they return None
+    once cancelled is set.
+    """
+    with rate_limiter:
+        if cancelled is None:
+            return client.messages.create(model=MODEL, max_tokens=max_tokens, messages=messages)
+        if cancelled.is_set():
+            return None
+        with client.messages.stream(model=MODEL, max_tokens=max_tokens, messages=messages) as stream:
+            for _ in stream:
+                if cancelled.is_set():
+                    return None
+            return stream.get_final_message()
+
+def create_message(client, max_tokens, messages, stats=None):
+    """
+    Make a model call, hedged when enabled. The tokens it used are counted
+    in stats['input_tokens'] and stats['output_tokens']. The losing request
+    of a hedged call is charged its input, the same as the winner's; its
+    output was cut short and is not known.
+    Calls are hedged against others with the same max_tokens and number of
+    messages, which tells identifications, extractions and continuations
+    apart.
+    """
+    if hedger is None:
+        response, requests = _request(client, max_tokens, messages), 1
+    else:
+        response, requests = hedger.call(
+            lambda cancelled: _request(client, max_tokens, messages, cancelled), stats,
+            kind=(max_tokens, len(messages))
+        )
+    usage = getattr(response, 'usage', None)
+    if stats is not None and usage is not None:
+        stats['input_tokens'] += usage.input_tokens * requests
+        stats['output_tokens'] += usage.output_tokens
+    return response
+
+def extract_data_from_image(client, image, prompt=DEFAULT_PROMPT, max_tokens=4096, stats=None,
+                            payload=None):
+    """
+    Send a page image to the model and return the parsed JSON result. The
+    image is sent PNG encoded, unless an already encoded payload is given
+    as (media_type, base64 data), see image_payload.
+    A response cut off by max_tokens is continued, up to MAX_CONTINUATIONS
+    times, by sending the partial output back as the start of the assistant
+    turn; the fragments are joined before parsing. Truncated responses are
+    counted in stats['truncated'] (and stats['continuations']).
+    API errors are raised to the caller.
+    """
+    if client is None:
+        raise RuntimeError("Anthropic client is not configured")
+    compact = COMPACT_OUTPUT and prompt == DEFAULT_PROMPT
+    if compact:
+        prompt, max_tokens = COMPACT_PROMPT, min(max_tokens, COMPACT_MAX_TOKENS)
+    
+    media_type, base64_image = payload or ("image/png", encode_image(image))
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text", 
+                    "text": prompt
+                },
+                {
+                    "type": "image",
+                    "source": {
+                        "type": "base64",
+                        "media_type": media_type,
+                        "data": base64_image
+                    }
+                }
+            ]
+        }
+    ]
+    
+    text = ''
+    for attempt in range(MAX_CONTINUATIONS + 1):
+        if attempt:
+            # Resume from the partial output, which may not end with whitespace
+            text = text.rstrip()
+            request = messages + [{"role": "assistant", "content": text}]
+            if stats is not None:
+                stats['continuations'] += 1
+        else:
+            request = messages
+        response = create_message(client, max_tokens, request, stats)
+        text += ''.join(block.text for block in response.content if block.type == 'text')
+        if response.stop_reason != 'max_tokens':
+            break
+        if attempt == 0 and stats is not None:
+            stats['truncated'] += 1
+    else:
+        logger.warning("Response still truncated after %d continuations", MAX_CONTINUATIONS)
+    
+    data = parse_response_text(text)
+    if compact and isinstance(data, dict) and 'raw_text' not in data:
+        return expand_compact(data)
+    return data
+
+# PDFs are read by poppler and PyPDF2 from their spooled file (see spooled)
+def pdf_info(pdf_path, source_file=''):
+    try:
+        import pdf2image  # imported on first use, it is not needed to show the app
+        return pdf2image.pdfinfo_from_path(pdf_path)
+    except Exception as e:
+        raise DocumentReadError(source_file) from e
+
+def pdf_page_count(pdf_path, source_file=''):
+    return int(pdf_info(pdf_path, source_file).get("Pages", 0))
+
+A4_POINTS = (595, 842)
+
+def pdf_page_pixels(info, dpi):
+    """
+    Return the (width, height) in pixels of the first page of a PDF rendered
+    at dpi, from its pdfinfo, e.g. 'Page size: 595.276 x 841.89 pts (A4)'.
+    """
+    match = re.match(r'\s*([\d.]+)\s*x\s*([\d.]+)', str(info.get("Page size", '')))
+    points = (float(match.group(1)), float(match.group(2))) if match else A4_POINTS
+    return tuple(int(side / 72 * dpi) for side in points)
+
+def pdf_to_images(pdf_path, first_page=None, last_page=None, source_file='', dpi=DPI_LADDER[0]):
+    try:
+        import pdf2image
+        return pdf2image.convert_from_path(pdf_path, dpi=dpi, first_page=first_page, last_page=last_page)
+    except Exception as e:
+        raise DocumentReadError(source_file) from e
+
+def pdf_page_texts(pdf_path):
+    """
+    Return the text layer of each page, or an empty list for scanned PDFs
+    without one. The file is memory-mapped rather than read.
+    """
+    try:
+        import PyPDF2
+        with open(pdf_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            reader = PyPDF2.PdfReader(mapped)
+            return [page.extract_text() or '' for page in reader.pages]
+    except Exception:
+        return []
+
+def open_image(image_path, source_file=''):
+    """
+    Open an image without decoding it: only the header is read here, pixel
+    data is decoded on first use. Use as a context manager to close the file.
+    """
+    try:
+        return Image.open(image_path)
+    except Exception as e:
+        raise DocumentReadError(source_file) from e
+
+def image_payload(image, image_path):
+    """
+    Return the (media_type, base64 data) to send for an uploaded image.
+    Images the model accepts within the size limits are passed through as
+    uploaded, without decoding. Larger ones are decoded at reduced scale
+    (JPEG draft mode decodes directly at 1/2, 1/4 or 1/8 of the size),
+    downscaled in place to DOWNSCALE_IMAGE_EDGE and re-encoded.
+    """
+    media_type = MEDIA_TYPES.get(image.format)
+    if media_type and os.path.getsize(image_path) <= MAX_IMAGE_BYTES and max(image.size) <= MAX_IMAGE_EDGE:
+        with open(image_path, 'rb') as f:
+            return media_type, base64.b64encode(f.read()).decode()
+    
+    if image.format == 'JPEG':
+        image.draft('RGB', (DOWNSCALE_IMAGE_EDGE, DOWNSCALE_IMAGE_EDGE))
+    image.thumbnail((DOWNSCALE_IMAGE_EDGE, DOWNSCALE_IMAGE_EDGE), Image.LANCZOS)
+    if image.mode in ('RGB', 'L'):
+        return "image/jpeg", encode_image(image, "JPEG")
+    return "image/png", encode_image(image)
+
+def iter_archive_entries(archive_file, name):
+    """
+    Yield (path, file object) for the supported documents of a ZIP or tar
+    archive, one entry at a time, without extracting the whole archive
+    first. Each file object is only readable until the next entry.
+    """
+    archive_file.seek(0)
+    try:
+        if name.lower().endswith('.zip'):
+            with zipfile.ZipFile(archive_file) as archive:
+                for info in archive.infolist():
+                    path = info.filename
+                    if info.is_dir() or path.startswith('__MACOSX/') or not path.lower().endswith(DOCUMENT_EXTENSIONS):
+                        continue
+                    with archive.open(info) as entry:
+                        yield path, entry
+        else:
+            # Stream mode reads members sequentially, compression is detected
+            with tarfile.open(fileobj=archive_file, mode='r|*') as archive:
+                for member in archive:
+                    if not member.isfile() or not member.name.lower().endswith(DOCUMENT_EXTENSIONS):
+                        continue
+                    yield member.name, archive.extractfile(member)
+    except (zipfile.BadZipFile, tarfile.TarError) as e:
+        raise DocumentReadError(name) from e
+
+def iter_documents(fileobj, name):
+    """
+    Yield (path, content hash, source file) for an uploaded document, or for
+    each supported document of an uploaded archive, with its path inside
+    the archive. Each document is spooled to a temporary file, deleted when
+    the next one is requested or the iteration is closed; close it with
+    contextlib.closing so that this happens even when the caller fails.
+    """
+    if not is_archive_name(name):
+        fileobj.seek(0)
+        with spooled(fileobj, name) as (path, key):
+            yield path, key, name
+        return
+    for entry_path, entry in iter_archive_entries(fileobj, name):
+        with spooled(entry, entry_path) as (path, key):
+            yield path, key, f"{name}/{entry_path}"
+
+# Cheap first pass reading only the business keys, used to recognise a
+# rescan of a document that was already extracted
+IDENTIFICATION_PROMPT = """Lis uniquement le numéro de police et le numéro de quittance de ce document d'assurance OGAR.
+Retourne uniquement un objet JSON: {"police_numero": "", "quittance_numero": ""}"""
+
+# Long edge of the downscaled copy sent for identification
+IDENTIFICATION_IMAGE_SIZE = 1024
+
+TEXT_KEY_PATTERNS = {
+    'police_numero': re.compile(r'police\s*(?:n\s*[°o]|num[ée]ro)?\s*[:.]?\s*([A-Z0-9][A-Z0-9/.\-]{3,})', re.IGNORECASE),
+    'quittance_numero': re.compile(r'quittance\s*(?:n\s*[°o]|num[ée]ro)?\s*[:.]?\s*([A-Z0-9][A-Z0-9/.\-]{3,})', re.IGNORECASE)
+}
+
+def business_keys_from_text(text):
+    keys = {}
+    for name, pattern in TEXT_KEY_PATTERNS.items():
+        match = pattern.search(text or '')
+        if match:
+            keys[name] = match.group(1)
+    return keys
+
+def identify_business_keys(client, image, text=None, stats=None):
+    """
+    Read the police and quittance numbers of a page, from the PDF text layer
+    when available, otherwise with a small request on a downscaled image.
+    """
+    keys = business_keys_from_text(text)
+    if keys.get('quittance_numero'):
+        return keys
+    
+    thumbnail = image.copy()
+    thumbnail.thumbnail((IDENTIFICATION_IMAGE_SIZE, IDENTIFICATION_IMAGE_SIZE))
+    try:
+        data = extract_data_from_image(client, thumbnail, IDENTIFICATION_PROMPT, max_tokens=100, stats=stats)
+    except Exception as e:
+        # Identification is only an optimisation, fall back to a full extraction
+        logger.warning("Identification failed: %s", e)
+        return keys
+    if isinstance(data, dict):
+        keys = {name: data.get(name) for name in TEXT_KEY_PATTERNS}
+    return keys
+
+# Characters the model uses for digits it could not make out
+UNREADABLE_MARKS = re.compile(r'[?…_*]|illisible', re.IGNORECASE)
+
+def needs_higher_resolution(data):
+    """
+    Tell whether an extraction suggests the page was not legible enough:
+    the response could not be parsed, or the police or quittance number is
+    missing, has no digit or contains unreadable marks.
+    """
+    if not isinstance(data, dict) or 'raw_text' in data:
+        return True
+    police = data.get('informations_police') or {}
+    for name in TEXT_KEY_PATTERNS:
+        value = str(police.get(name) or '')
+        if not re.search(r'\d', value) or UNREADABLE_MARKS.search(value):
+            return True
+    return False
+
+def _report(on_error, error):
+    if on_error:
+        on_error(error)
+    else:
+        logger.warning("Extraction failed: %s", error, exc_info=error)
+
+def extract_page(client, store, key, page, source_file, image, prompt=DEFAULT_PROMPT,
+                 text=None, force_refresh=False, stats=None, dpi=None, render=None,
+                 payload=None, page_hash=None, page_count=1):
+    """
+    Extract a page and write its result to the durable store as soon as it
+    completes, so that a restarted run can skip it.
+    Unless force_refresh is set, a prior extraction is reused when the page
+    content is identical (e.g. a modified copy of the same PDF) or, for
+    pages of a multi-page document, when the same page of another document
+    of page_count pages carries the same quittance/police numbers (e.g. a
+    rescan), and pages with a learned layout are read locally (see
+    templates.py). Single-page documents are not reused by business key:
+    the separate scans of the pages of a quittance all carry its numbers.
+    PDF pages are passed with the dpi they were rendered at and a
+    render(dpi) callable, used to retry the model extraction at the next
+    resolution of DPI_LADDER when it fails validation. Uploaded images are
+    passed with their encoded payload and the hash of their bytes, so that
+    they are only decoded when templates or identification need pixels.
+    """
+    page_hash = page_hash or image_hash(image)
+    data = None
+    status = 'reused'
+    read_dpi = dpi
+    if not force_refresh:
+        data = find_by_page_hash(store, page_hash)
+        if data is None and prompt == DEFAULT_PROMPT:
+            # Known layouts are read locally from their template zones,
+            # the model reads the page when that fails
+            try:
+                data = zonal_extract(store, image, RESULT_TEMPLATE)
+            except Exception as e:
+                logger.warning("Zonal extraction failed: %s", e)
+            status = 'zonal'
+        if data is None and page_count > 1 and has_business_keys(store):
+            keys = identify_business_keys(client, image, text, stats)
+            data = find_by_business_keys(
+                store, keys.get('quittance_numero'), keys.get('police_numero'), page, page_count, key
+            )
+            status = 'reused'
+        if data is not None and status == 'reused':
+            # Read at whatever resolution the reused page was
+            read_dpi = None
+    
+    if data is None:
+        data = extract_data_from_image(client, image, prompt, stats=stats, payload=payload)
+        status = 'extracted'
+        if render is not None and prompt == DEFAULT_PROMPT:
+            for next_dpi in [step for step in DPI_LADDER if step > dpi]:
+                if not needs_higher_resolution(data):
+                    break
+                logger.info("%s page %s: retrying at %d dpi", source_file, page, next_dpi)
+                image = render(next_dpi)
+                data = extract_data_from_image(client, image, prompt, stats=stats)
+                read_dpi = next_dpi
+        if prompt == DEFAULT_PROMPT:
+            try:
+                learn_template(store, image, data)
+            except Exception as e:
+                logger.warning("Template learning failed: %s", e)
+    
+    if read_dpi is not None:
+        logger.info("%s page %s: %s at %d dpi", source_file, page, status, read_dpi)
+    save_page_result(store, key, page, data, source_file, page_hash, read_dpi)
+    if stats is not None:
+        stats[status] += 1
+
+def pipeline_sizes(info):
+    """
+    Return (raster workers, queue size, extraction workers) for a PDF, so
+    that the pages rendered, queued and being extracted fit within
+    MEMORY_LIMIT_MB. Pages are assumed the size of the first one at the top
+    of the DPI ladder, held decoded and once more encoded for the request.
+    """
+    if not MEMORY_LIMIT_MB:
+        return RASTER_WORKERS, PAGE_QUEUE_SIZE, EXTRACTION_WORKERS
+    width, height = pdf_page_pixels(info, max(DPI_LADDER))
+    pages = MEMORY_LIMIT_MB * 1024 * 1024 // (width * height * 3 * 2)
+    raster = max(1, min(RASTER_WORKERS, pages // 3))
+    extraction = max(1, min(EXTRACTION_WORKERS, pages // 3))
+    return raster, max(1, min(PAGE_QUEUE_SIZE, pages - raster - extraction)), extraction
+
+def render_pages(pdf_path, pages, source_file, page_queue, workers=RASTER_WORKERS):
+    """
+    Producer: render the given pages, each by its own poppler process on up
+    to workers threads, and put (page, image, error) on page_queue in page
+    order. Blocks while the queue is full, which bounds the number of
+    rendered pages held in memory.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for page in pages:
+            pending.append((page, pool.submit(pdf_to_images, pdf_path, page, page, source_file)))
+            if len(pending) >= workers:
+                _put_rendered(page_queue, *pending.popleft())
+        while pending:
+            _put_rendered(page_queue, *pending.popleft())
+
+def _put_rendered(page_queue, page, future):
+    try:
+        page_queue.put((page, future.result()[0], None))
+    except Exception as e:
+        page_queue.put((page, None, e))
+
+def process_pdf(client, store, key, pdf_path, source_file, prompt=DEFAULT_PROMPT,
+                force_refresh=False, on_error=None, stats=None):
+    """
+    Extract every page of a PDF file, resuming from the pages already
+    completed in the durable store. Pages are rendered and extracted
+    concurrently (see render_pages and pipeline_sizes); errors are reported
+    from the calling thread once all pages are done. Returns (pages, complete).
+    """
+    completed = set() if force_refresh else completed_pages(store, key)
+    try:
+        info = pdf_info(pdf_path, source_file)
+    except DocumentReadError as e:
+        _report(on_error, e)
+        return [], False
+    page_count = int(info.get("Pages", 0))
+    texts = pdf_page_texts(pdf_path)
+    
+    todo = [page for page in range(1, page_count + 1) if page not in completed]
+    done = set(range(1, page_count + 1)) - set(todo)
+    errors = []
+    lock = threading.Lock()
+    raster_workers, queue_size, extraction_workers = pipeline_sizes(info)
+    page_queue = queue.Queue(maxsize=queue_size)
+    
+    def consume():
+        while True:
+            item = page_queue.get()
+            if item is None:
+                return
+            page, image, error = item
+            page_stats = Counter()
+            if error is None:
+                try:
+                    extract_page(
+                        client, store, key, page, source_file, image, prompt,
+                        text=texts[page - 1] if page <= len(texts) else None,
+                        force_refresh=force_refresh, stats=page_stats, dpi=DPI_LADDER[0],
+                        page_count=page_count,
+                        render=lambda dpi, page=page: pdf_to_images(pdf_path, page, page, source_file, dpi)[0]
+                    )
+                except Exception as e:
+                    error = e
+            with lock:
+                # Tokens spent on a failed page count too, its status is
+                # only counted by extract_page once the result is saved
+                if stats is not None:
+                    stats.update(page_stats)
+                if error is None:
+                    done.add(page)
+                else:
+                    errors.append(error)
+    
+    if todo:
+        consumers = [
+            threading.Thread(target=consume, daemon=True)
+            for _ in range(min(extraction_workers, len(todo)))
+        ]
+        for consumer in consumers:
+            consumer.start()
+        try:
+            render_pages(pdf_path, todo, source_file, page_queue, raster_workers)
+        finally:
+            for _ in consumers:
+                page_queue.put(None)
+            for consumer in consumers:
+                consumer.join()
+    
+    for error in errors:
+        _report(on_error, error)
+    pages = sorted(done)
+    return pages, page_count > 0 and len(pages) == page_count
+
+def process_image(client, store, key, image_path, source_file, prompt=DEFAULT_PROMPT,
+                  force_refresh=False, on_error=None, stats=None):
+    """
+    Extract a single image file. Returns (pages, complete).
+    """
+    if force_refresh or 1 not in completed_pages(store, key):
+        try:
+            with open_image(image_path, source_file) as image:
+                extract_page(client, store, key, 1, source_file, image, prompt,
+                             force_refresh=force_refresh, stats=stats,
+                             payload=image_payload(image, image_path), page_hash=key)
+        except Exception as e:
+            _report(on_error, e)
+            return [], False
+    return [1], True
+
+def process_document(client, store, path, key, source_file, prompt=DEFAULT_PROMPT,
+                     force_refresh=False, on_error=None, stats=None):
+    """
+    Extract a single PDF or image file, keyed by its content hash. Returns
+    (items, complete) where items are the (store_key, page, source_file,
+    display_page) references of its pages.
+    """
+    if is_pdf_name(source_file):
+        pages, complete = process_pdf(client, store, key, path, source_file, prompt,
+                                      force_refresh, on_error, stats)
+        return [(key, page, source_file, page) for page in pages], complete
+    pages, complete = process_image(client, store, key, path, source_file, prompt,
+                                    force_refresh, on_error, stats)
+    return [(key, page, source_file, '') for page in pages], complete
+
+def process_upload(client, store, fileobj, name, prompt=DEFAULT_PROMPT,
+                   force_refresh=False, on_error=None, stats=None):
+    """
+    Extract an uploaded file. Archives are expanded entry by entry, each
+    entry being keyed by its own content hash and recorded with its path
+    inside the archive as source file. Every document is processed from a
+    temporary copy on disk (see iter_documents). Returns (items, complete).
+    """
+    items = []
+    complete = True
+    try:
+        with closing(iter_documents(fileobj, name)) as documents:
+            for path, key, source_file in documents:
+                document_items, document_complete = process_document(
+                    client, store, path, key, source_file, prompt,
+                    force_refresh, on_error, stats
+                )
+                items.extend(document_items)
+                complete = complete and document_complete
+    except DocumentReadError as e:
+        _report(on_error, e)
+        complete = False
+    return items, complete
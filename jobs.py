@@ -0,0 +1,212 @@
+"""
+Shared job store for extraction work.
+
+Uploads are queued as jobs in a SQLite database in WAL mode, consumed by
+any number of worker processes (see worker.py) on the same host: WAL
+relies on memory shared between the processes, so the database, like the
+result store, must not be shared over a network filesystem. A worker
+claims a job by taking a lease on it and renews the lease with heartbeats
+while the job runs. A job whose lease expires, because its worker crashed
+or was stopped, is claimed again by another worker, up to MAX_ATTEMPTS
+times.
+
+Uploads are stored in the job database as blobs, written and read back in
+chunks of CHUNK_SIZE bytes, so that neither the front end queuing them nor
+the worker running them holds an upload in memory whole. The pages of a
+job are written to the result store as they complete (see store.py), so a
+retried job resumes where the abandoned one stopped.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+DEFAULT_JOBS_PATH = os.getenv('OGAR_JOBS_PATH', 'ogar_jobs.db')
+
+# Seconds a claimed job stays reserved without a heartbeat
+LEASE_SECONDS = int(os.getenv('OGAR_JOB_LEASE_SECONDS', '60'))
+# Claims of a job before it is given up as failed
+MAX_ATTEMPTS = int(os.getenv('OGAR_JOB_MAX_ATTEMPTS', '3'))
+# Bytes of an upload copied at a time into or out of the job database
+CHUNK_SIZE = 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    batch_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    data BLOB,
+    force_refresh INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_batch ON jobs (batch_id, position);
+"""
+
+FINISHED = ('done', 'failed')
+
+# A single connection is shared by the threads of a process
+_lock = threading.RLock()
+
+def open_jobs(path=DEFAULT_JOBS_PATH):
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+def enqueue_batch(conn, uploads, force_refresh=False):
+    """
+    Queue a list of (name, file object) uploads, one job each. Each file is
+    copied from its start into a blob of its size, chunk by chunk. Returns
+    (batch_id, job ids in upload order).
+    """
+    batch_id = uuid.uuid4().hex
+    job_ids = [uuid.uuid4().hex for _ in uploads]
+    now = time.time()
+    with _lock:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for position, (job_id, (name, fileobj)) in enumerate(zip(job_ids, uploads)):
+                size = fileobj.seek(0, os.SEEK_END)
+                fileobj.seek(0)
+                cursor = conn.execute(
+                    "INSERT INTO jobs (id, batch_id, position, name, data, force_refresh, created_at) "
+                    "VALUES (?, ?, ?, ?, zeroblob(?), ?, ?)",
+                    (job_id, batch_id, position, name, size, int(force_refresh), now)
+                )
+                with conn.blobopen('jobs', 'data', cursor.lastrowid) as blob:
+                    for chunk in iter(lambda: fileobj.read(min(CHUNK_SIZE, size - blob.tell())), b''):
+                        blob.write(chunk)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return batch_id, job_ids
+
+def claim_job(conn, worker, lease_seconds=LEASE_SECONDS):
+    """
+    Lease the oldest pending job, or a running job whose lease has expired.
+    Returns (job_id, name, force_refresh), or None when there is nothing to
+    do; the upload is read with read_job_data.
+    """
+    now = time.time()
+    with _lock:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            while True:
+                row = conn.execute(
+                    "SELECT id, name, force_refresh, attempts FROM jobs "
+                    "WHERE status = 'pending' OR (status = 'running' AND lease_expires < ?) "
+                    "ORDER BY created_at, position LIMIT 1",
+                    (now,)
+                ).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                job_id, name, force_refresh, attempts = row
+                if attempts < MAX_ATTEMPTS:
+                    break
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', data = NULL, error = ?, finished_at = ? WHERE id = ?",
+                    (f"Abandoned after {attempts} attempts", now, job_id)
+                )
+            conn.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                (worker, now + lease_seconds, job_id)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return job_id, name, bool(force_refresh)
+
+def read_job_data(conn, job_id, fileobj):
+    """
+    Copy the upload of a job into a file object, chunk by chunk. The blob
+    is read under the lock, as a heartbeat updating the row meanwhile would
+    invalidate it.
+    """
+    with _lock:
+        (rowid,) = conn.execute("SELECT rowid FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        with conn.blobopen('jobs', 'data', rowid, readonly=True) as blob:
+            for chunk in iter(lambda: blob.read(CHUNK_SIZE), b''):
+                fileobj.write(chunk)
+
+def heartbeat(conn, job_id, worker, lease_seconds=LEASE_SECONDS):
+    """
+    Extend the lease of a running job. Returns False when the worker no
+    longer holds it.
+    """
+    with _lock:
+        cursor = conn.execute(
+            "UPDATE jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND status = 'running'",
+            (time.time() + lease_seconds, job_id, worker)
+        )
+    return cursor.rowcount == 1
+
+def finish_job(conn, job_id, worker, result):
+    """
+    Record the result of a job, unless its lease was taken over meanwhile.
+    """
+    with _lock:
+        cursor = conn.execute(
+            "UPDATE jobs SET status = 'done', data = NULL, result = ?, finished_at = ? "
+            "WHERE id = ? AND worker = ? AND status = 'running'",
+            (json.dumps(result, ensure_ascii=False), time.time(), job_id, worker)
+        )
+    return cursor.rowcount == 1
+
+def fail_job(conn, job_id, worker, error):
+    """
+    Put a failed job back in the queue, or mark it failed once it has used
+    up its attempts.
+    """
+    with _lock:
+        cursor = conn.execute(
+            "UPDATE jobs SET "
+            "status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, "
+            "data = CASE WHEN attempts < ? THEN data END, "
+            "finished_at = CASE WHEN attempts < ? THEN NULL ELSE ? END, "
+            "worker = NULL, lease_expires = NULL, error = ? "
+            "WHERE id = ? AND worker = ? AND status = 'running'",
+            (MAX_ATTEMPTS, MAX_ATTEMPTS, MAX_ATTEMPTS, time.time(), str(error), job_id, worker)
+        )
+    return cursor.rowcount == 1
+
+def batch_jobs(conn, batch_id):
+    """
+    Return the jobs of a batch in upload order, as dicts with id, name,
+    status, attempts, result and error; an empty list for an unknown batch.
+    """
+    with _lock:
+        rows = conn.execute(
+            "SELECT id, name, status, attempts, result, error FROM jobs WHERE batch_id = ? ORDER BY position",
+            (batch_id,)
+        ).fetchall()
+    return [
+        {
+            'id': job_id, 'name': name, 'status': status, 'attempts': attempts,
+            'result': json.loads(result) if result else None, 'error': error
+        }
+        for job_id, name, status, attempts, result, error in rows
+    ]
+
+def prune_jobs(conn, retention_seconds):
+    # Drop finished jobs older than the retention period
+    with _lock:
+        conn.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+            (time.time() - retention_seconds,)
+        )
@@ -0,0 +1,289 @@
+"""
+Extraction schema.
+
+The fields requested by DEFAULT_PROMPT are compiled once into a fixed list
+of FieldSpec, each with its index. An extracted document can then be held
+as a compact Record: one slot per schema field, aligned with that list,
+plus the few fields outside the schema that the model may add. This avoids
+a nested dict repeating ~100 key strings per page, and records convert
+column by column to the table view and the exports.
+"""
+import functools
+import json
+from collections import namedtuple
+
+# Extraction prompt (hidden from users)
+DEFAULT_PROMPT = """Extrais TOUS les champs de ce document d'assurance OGAR en français.
+Retourne un objet JSON détaillé avec la structure suivante 
+
+(POINT D'ATTENTION !!! Les champs peuvent légèrement varier dans le nom/désignation/intitulé/description/etc. 
+Assure-toi de bien extraire tous les champs possibles où les libellées ont la même connotation/sens/signification:
+
+{
+  "informations_compagnie": {
+    "nom_compagnie": "",
+    "telephone": "",
+    "fax": "",
+    "bp": "",
+    "email": "",
+    "courtier": ""
+  },
+  "informations_police": {
+    "police_numero": "",
+    "quittance_numero": "",
+    "emission_date": "",
+    "effet_du": "",
+    "effet_heure": "",
+    "echeance_au": "",
+    "echeance_heure": "",
+    "compagnie": "",
+    "affaire": ""
+  },
+  "designation_vehicule": {
+    "marque": "",
+    "genre": "",
+    "type": "",
+    "carrosserie": "",
+    "energie": "",
+    "puissance": "",
+    "nombre_places": "",
+    "valeur_neuve": "",
+    "valeur_venale": "",
+    "mise_circulation": "",
+    "immatriculation": "",
+    "chassis": "",
+    "usage": ""
+  },
+  "souscripteur": {
+    "nom": "",
+    "numero_client": "",
+    "bp": "",
+    "ville": "",
+    "pays": "",
+    "telephone": "",
+    "fax": ""
+  },
+  "assure": {
+    "nom": "",
+    "bp": "",
+    "ville": "",
+    "pays": "",
+    "telephone": "",
+    "fax": ""
+  },
+  "garanties": {
+    "risque_a_responsabilite_civile": {"valeur": "", "franchise": "", "prime": ""},
+    "risque_b_recours_tiers_incendie": {"valeur": "", "franchise": "", "prime": ""},
+    "risque_c_defense_recours": {"valeur": "", "franchise": "", "prime": ""},
+    "risque_d_avance_recours": {"valeur": "", "franchise": "", "prime": ""},
+    "risque_e_incendie": {"valeur": "", "franchise": "", "prime": ""},
+    "risque_f_vol": {"valeur": "", "franchise": "", "prime": ""},
+    "risque_g_vol_agression": {"valeur": "", "franchise": "", "prime": ""},
+    "risque_h_bris_glace": {"valeur": "", "franchise": "", "prime": ""},
+    "risque_i_perte_totale": {"valeur": "", "franchise": "", "prime": ""},
+    "risque_j_tierce_collision": {"valeur": "", "franchise": "", "prime": ""},
+    "risque_k_dommages": {"valeur": "", "franchise": "", "prime": ""},
+    "risque_l_nombre_passagers": {"valeur": "", "franchise": "", "prime": ""},
+    "risque_m_pt_camion": {"valeur": "", "franchise": "", "prime": ""},
+    "risque_n_pt_eleves": {"valeur": "", "franchise": "", "prime": ""},
+    "risque_o_passagers_clandestins": {"valeur": "", "franchise": "", "prime": ""},
+    "risque_p_remorque": {"valeur": "", "franchise": "", "prime": ""},
+    "risque_q_individuelle_passagers": {"valeur": "", "franchise": "", "prime": ""},
+    "risque_r_assistance": {"valeur": "", "franchise": "", "prime": ""}
+  },
+  "tarif": {
+    "bonus": "",
+    "taux_pourcent": "",
+    "montant": "",
+    "stat_auto": "",
+    "stat_ip": ""
+  },
+  "capitaux_individuelle_passager": {
+    "deces": "",
+    "ipp": "",
+    "frais_medicaux": ""
+  },
+  "primes_detail": {
+    "prime_nette_brute": "",
+    "reductions": "",
+    "prime_nette_reduite_deduites": "",
+    "accessoires": "",
+    "taxes": "",
+    "cemac": "",
+    "css": "",
+    "tsvl": "",
+    "cca": "",
+    "prime_totale": ""
+  }
+}
+
+Extrais chaque champ visible dans le document. Si un champ est vide ou non visible, utilise une chaîne vide "". 
+Sois précis et exhaustif. N'oublie aucun champ.
+
+DANS LE CAS OU LES INTITULES DIFFERENT FAIT DES CORRESPONDANCES logiques entre les champs pour retrouver la valeur correspondante !!! 
+
+"""
+
+# Empty result structure requested by DEFAULT_PROMPT
+RESULT_TEMPLATE = json.loads(DEFAULT_PROMPT[DEFAULT_PROMPT.index('{'):DEFAULT_PROMPT.rindex('}') + 1])
+
+# A schema field: dotted path in the result, and its table view labels
+FieldSpec = namedtuple('FieldSpec', ['index', 'path', 'categorie', 'nom'])
+
+def _cell(value):
+    # Same conversion as flatten_json_to_structured_format
+    if isinstance(value, list):
+        return ', '.join(map(str, value)) if value else ''
+    return str(value) if value is not None else ''
+
+@functools.lru_cache(maxsize=1024)
+def category_label(key):
+    # Label of a top-level key, e.g. 'informations_police' -> 'Informations Police'
+    return key.replace('_', ' ').title()
+
+def _iter_fields(data):
+    """
+    Yield (path, categorie, nom, value) for every leaf of a result, with
+    the labels of flatten_json_to_structured_format: the top-level key as
+    category, and the leaf key as field name. Nested dicts are walked with
+    a stack of item iterators rather than recursive generators.
+    """
+    stack = [(iter(data.items()), (), '')]
+    while stack:
+        items, path, category = stack[-1]
+        for key, value in items:
+            field_category = category or category_label(key)
+            if isinstance(value, dict):
+                stack.append((iter(value.items()), path + (key,), field_category))
+                break
+            yield path + (key,), field_category, key, value
+        else:
+            stack.pop()
+
+def flatten_columns(data, columns=None):
+    """
+    Flatten a result into (categories, names, values) column lists, with
+    the labels and cells of flatten_json_to_structured_format, appending to
+    the given columns when passed. Iterative, and without a dict per field,
+    so that a DataFrame can be built directly from the columns.
+    """
+    categories, names, values = columns if columns is not None else ([], [], [])
+    if not isinstance(data, dict):
+        categories.append('')
+        names.append('')
+        values.append(_cell(data))
+        return categories, names, values
+    
+    stack = [(iter(data.items()), '')]
+    while stack:
+        items, category = stack[-1]
+        for key, value in items:
+            field_category = category or category_label(key)
+            if isinstance(value, dict):
+                stack.append((iter(value.items()), field_category))
+                break
+            categories.append(field_category)
+            names.append(key)
+            values.append(_cell(value))
+        else:
+            stack.pop()
+    return categories, names, values
+
+def compile_schema(template):
+    return tuple(
+        FieldSpec(index, '.'.join(path), categorie, nom)
+        for index, (path, categorie, nom, _) in enumerate(_iter_fields(template))
+    )
+
+SCHEMA = compile_schema(RESULT_TEMPLATE)
+SCHEMA_INDEX = {field.path: field.index for field in SCHEMA}
+
+class Record:
+    """
+    Compact form of an extracted document.
+
+    values holds the cell of each SCHEMA field, in schema order, or None
+    when the field is absent from the result. extra holds
+    (path, categorie, nom, valeur) for fields outside the schema.
+    """
+    __slots__ = ('values', 'extra', '_columns')
+    
+    def __init__(self, values, extra=()):
+        self.values = values
+        self.extra = extra
+        self._columns = None
+    
+    def fields(self):
+        """
+        Yield (path, categorie, nom, valeur) for the fields present in the
+        document, schema fields first.
+        """
+        for field, value in zip(SCHEMA, self.values):
+            if value is not None:
+                yield field.path, field.categorie, field.nom, value
+        yield from self.extra
+    
+    def columns(self):
+        """
+        Return the (categories, names, values) columns of fields(), built
+        once per record.
+        """
+        if self._columns is None:
+            rows = list(self.fields())
+            self._columns = (
+                [row[1] for row in rows], [row[2] for row in rows], [row[3] for row in rows]
+            )
+        return self._columns
+    
+    def to_dict(self):
+        data = {}
+        for path, _, _, value in self.fields():
+            *parents, name = path.split('.')
+            target = data
+            for parent in parents:
+                target = target.setdefault(parent, {})
+            target[name] = value
+        return data
+
+# Compact output mode: the model returns minified JSON keyed by the index
+# of each schema field, with the non-empty fields only, instead of echoing
+# the whole template. expand_compact maps it back to the full structure.
+COMPACT_PROMPT = f"""Extrais les champs de ce document d'assurance OGAR en français.
+Retourne UNIQUEMENT un objet JSON minifié, sans espaces ni retours à la ligne, dont les clés sont
+les codes ci-dessous et les valeurs le texte lu sur le document, par exemple {{"{SCHEMA_INDEX['informations_police.police_numero']}":"1234567","{SCHEMA_INDEX['designation_vehicule.immatriculation']}":"AB-123-CD"}}.
+N'inclus que les champs présents et non vides : omets tous les autres.
+
+(POINT D'ATTENTION !!! Les intitulés peuvent légèrement varier sur le document : fais des
+correspondances logiques entre les libellés de même sens pour retrouver la valeur de chaque champ.)
+
+Codes des champs :
+""" + "\n".join(f"{field.index}={field.path}" for field in SCHEMA) + "\n"
+
+def expand_compact(data):
+    """
+    Expand a compact mode result to the structure of RESULT_TEMPLATE, with
+    an empty string for every field the model left out. Unknown codes are
+    dropped.
+    """
+    values = [''] * len(SCHEMA)
+    for code, value in data.items():
+        index = int(code) if str(code).isdigit() else None
+        if index is not None and index < len(SCHEMA):
+            values[index] = _cell(value)
+    return Record(tuple(values)).to_dict()
+
+def to_record(data):
+    """
+    Convert an extraction result (nested dict) to a Record.
+    """
+    values = [None] * len(SCHEMA)
+    extra = []
+    if isinstance(data, dict):
+        for path, categorie, nom, value in _iter_fields(data):
+            path = '.'.join(path)
+            index = SCHEMA_INDEX.get(path)
+            if index is None:
+                extra.append((path, categorie, nom, _cell(value)))
+            else:
+                values[index] = _cell(value)
+    return Record(tuple(values), tuple(extra))
@@ -0,0 +1,553 @@
+"""
+Durable storage of extraction results.
+
+Each completed page is written as soon as it finishes, keyed by the content
+hash of its source file and its page number, so that an interrupted batch
+can skip completed pages and resume where it stopped.
+
+Results are also kept here rather than in session memory: the flattened
+fields are stored row by row so that the table view can be filtered and
+paginated in SQL, and documents are loaded one at a time on demand. Field
+rows only hold an id into the field_names dictionary, not the repeated
+category and field name strings.
+
+Every document is indexed for historical lookups: B-tree indexes on the
+normalized business keys (police, quittance, immatriculation, chassis) and
+an FTS5 full-text index over all extracted values.
+"""
+import json
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from schema import to_record
+
+DEFAULT_STORE_PATH = os.getenv('OGAR_STORE_PATH', 'ogar_results.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS page_results (
+    file_hash TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    source_file TEXT,
+    page_hash TEXT,
+    dpi INTEGER,
+    data TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (file_hash, page)
+);
+CREATE INDEX IF NOT EXISTS idx_page_results_page_hash ON page_results (page_hash);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5 (
+    content,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+
+CREATE TABLE IF NOT EXISTS templates (
+    id INTEGER PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    observations INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS template_zones (
+    template_id INTEGER NOT NULL,
+    field TEXT NOT NULL,
+    x0 REAL,
+    y0 REAL,
+    x1 REAL,
+    y1 REAL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    misses INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (template_id, field)
+);
+
+CREATE TABLE IF NOT EXISTS field_names (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    categorie TEXT NOT NULL,
+    nom TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS page_fields (
+    file_hash TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    field_id INTEGER NOT NULL,
+    valeur TEXT,
+    PRIMARY KEY (file_hash, page, position)
+);
+
+CREATE TABLE IF NOT EXISTS usage (
+    user TEXT NOT NULL,
+    day TEXT NOT NULL,
+    tokens INTEGER NOT NULL DEFAULT 0,
+    cost REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (user, day)
+);
+"""
+
+# Business keys indexed for lookups, by field name in the extraction schema
+KEY_FIELDS = ['police_numero', 'quittance_numero', 'immatriculation', 'chassis']
+
+# A single connection is shared by all Streamlit sessions of the process
+_lock = threading.RLock()
+
+# Records of recently loaded documents, by (file_hash, page), so that
+# repeated exports and API polls flatten each document once
+RECORD_CACHE_SIZE = 2048
+_records = OrderedDict()
+
+# Per connection: ({path: field id}, {field id: (categorie, nom)}), so that
+# every row of a field shares the same label strings
+_field_names = {}
+
+def open_store(path=DEFAULT_STORE_PATH):
+    # Several worker processes may write concurrently (see worker.py), wait
+    # for their transactions rather than failing at once
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    _migrate(conn)
+    return conn
+
+def _migrate(conn):
+    """
+    Add the business key columns and their indexes to stores created before
+    they existed, and index the documents already stored.
+    """
+    field_columns = {row[1] for row in conn.execute("PRAGMA table_info(page_fields)")}
+    if 'categorie' in field_columns:
+        # Field rows used to repeat their labels, rebuild them with field ids
+        conn.execute("DROP TABLE page_fields")
+        conn.executescript(SCHEMA)
+        rows = conn.execute("SELECT file_hash, page, data FROM page_results").fetchall()
+        conn.execute("BEGIN")
+        for file_hash, page, data in rows:
+            _insert_fields(conn, file_hash, page, json.loads(data))
+        conn.execute("COMMIT")
+    
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(page_results)")}
+    if 'dpi' not in columns:
+        conn.execute("ALTER TABLE page_results ADD COLUMN dpi INTEGER")
+    missing = [name for name in KEY_FIELDS if name not in columns]
+    for name in missing:
+        conn.execute(f"ALTER TABLE page_results ADD COLUMN {name} TEXT")
+    for name in KEY_FIELDS:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_page_results_{name} ON page_results ({name})")
+    
+    if missing:
+        rows = conn.execute("SELECT rowid, source_file, data FROM page_results").fetchall()
+        conn.execute("BEGIN")
+        for rowid, source_file, data in rows:
+            data = json.loads(data)
+            keys = business_keys(data)
+            conn.execute(
+                "UPDATE page_results SET " + ", ".join(f"{name} = ?" for name in KEY_FIELDS) +
+                " WHERE rowid = ?",
+                [keys[name] for name in KEY_FIELDS] + [rowid]
+            )
+            conn.execute("DELETE FROM documents_fts WHERE rowid = ?", (rowid,))
+            conn.execute(
+                "INSERT INTO documents_fts (rowid, content) VALUES (?, ?)",
+                (rowid, _document_text(data, source_file))
+            )
+        conn.execute("COMMIT")
+
+def normalize_key(value):
+    """
+    Normalize a business key for indexing and lookup: uppercase, without
+    spaces or separators, so that 'AB-123 CD' and 'ab123cd' match.
+    """
+    return re.sub(r'[^0-9A-Z]', '', str(value or '').upper())
+
+def _find_value(data, name):
+    # Fields may be nested under any category
+    if isinstance(data, dict):
+        value = data.get(name)
+        if value and not isinstance(value, (dict, list)):
+            return value
+        for child in data.values():
+            found = _find_value(child, name)
+            if found:
+                return found
+    return None
+
+def business_keys(data):
+    return {name: normalize_key(_find_value(data, name)) or None for name in KEY_FIELDS}
+
+def _leaf_values(data):
+    if isinstance(data, dict):
+        for value in data.values():
+            yield from _leaf_values(value)
+    elif isinstance(data, list):
+        for value in data:
+            yield from _leaf_values(value)
+    elif data not in (None, ''):
+        yield str(data)
+
+def _document_text(data, source_file):
+    return " ".join([source_file or ''] + list(_leaf_values(data)))
+
+def _load_field_names(conn):
+    if conn not in _field_names:
+        ids, names = {}, {}
+        for field_id, path, categorie, nom in conn.execute("SELECT id, path, categorie, nom FROM field_names"):
+            ids[path] = field_id
+            names[field_id] = (categorie, nom)
+        _field_names[conn] = (ids, names)
+    return _field_names[conn]
+
+def _insert_fields(conn, file_hash, page, data):
+    # Must run inside a transaction
+    ids, names = _load_field_names(conn)
+    rows = []
+    for position, (path, categorie, nom, valeur) in enumerate(to_record(data).fields()):
+        if path not in ids:
+            # Another process may have added the same field meanwhile
+            conn.execute(
+                "INSERT OR IGNORE INTO field_names (path, categorie, nom) VALUES (?, ?, ?)",
+                (path, categorie, nom)
+            )
+            field_id, categorie, nom = conn.execute(
+                "SELECT id, categorie, nom FROM field_names WHERE path = ?", (path,)
+            ).fetchone()
+            ids[path] = field_id
+            names[field_id] = (categorie, nom)
+        rows.append((file_hash, page, position, ids[path], valeur))
+    
+    conn.execute(
+        "DELETE FROM page_fields WHERE file_hash = ? AND page = ?",
+        (file_hash, page)
+    )
+    conn.executemany(
+        "INSERT INTO page_fields (file_hash, page, position, field_id, valeur) VALUES (?, ?, ?, ?, ?)",
+        rows
+    )
+
+def save_page_result(conn, file_hash, page, data, source_file=None, page_hash=None, dpi=None):
+    """
+    Write a page result and its flattened fields in a single transaction.
+    dpi is the resolution the page was read at, None for images and reused
+    results.
+    """
+    keys = business_keys(data)
+    with _lock:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT rowid FROM page_results WHERE file_hash = ? AND page = ?",
+                (file_hash, page)
+            ).fetchone()
+            if row:
+                conn.execute("DELETE FROM documents_fts WHERE rowid = ?", (row[0],))
+            
+            cursor = conn.execute(
+                "INSERT OR REPLACE INTO page_results "
+                "(file_hash, page, source_file, page_hash, dpi, data, created_at, " +
+                ", ".join(KEY_FIELDS) + ") VALUES (?, ?, ?, ?, ?, ?, ?" +
+                ", ?" * len(KEY_FIELDS) + ")",
+                [file_hash, page, source_file, page_hash, dpi,
+                 json.dumps(data, ensure_ascii=False), datetime.now().isoformat()] +
+                [keys[name] for name in KEY_FIELDS]
+            )
+            conn.execute(
+                "INSERT INTO documents_fts (rowid, content) VALUES (?, ?)",
+                (cursor.lastrowid, _document_text(data, source_file))
+            )
+            _insert_fields(conn, file_hash, page, data)
+            conn.execute("COMMIT")
+            _records.pop((file_hash, page), None)
+        except Exception:
+            conn.execute("ROLLBACK")
+            # Field ids created in the rolled back transaction are gone
+            _field_names.pop(conn, None)
+            raise
+
+def completed_pages(conn, file_hash):
+    with _lock:
+        rows = conn.execute(
+            "SELECT page FROM page_results WHERE file_hash = ?",
+            (file_hash,)
+        ).fetchall()
+    return {row[0] for row in rows}
+
+def find_by_page_hash(conn, page_hash):
+    """
+    Return the result of a previously extracted page with identical content.
+    """
+    with _lock:
+        row = conn.execute(
+            "SELECT data FROM page_results WHERE page_hash = ? LIMIT 1",
+            (page_hash,)
+        ).fetchone()
+    return json.loads(row[0]) if row else None
+
+def find_by_business_keys(conn, quittance_numero, police_numero=None, page=1, page_count=1,
+                          exclude_file_hash=None):
+    """
+    Return the most recent extraction of the same page of the same quittance
+    (and policy, when known) in another file of the same page count, e.g.
+    from an earlier scan of the same document. The other pages of a document
+    usually repeat its numbers, they must not be taken for one another.
+    """
+    quittance_numero = normalize_key(quittance_numero)
+    police_numero = normalize_key(police_numero) or None
+    if not quittance_numero:
+        return None
+    with _lock:
+        row = conn.execute(
+            "SELECT data FROM page_results WHERE quittance_numero = ? "
+            "AND (? IS NULL OR police_numero = ?) AND page = ? AND file_hash IS NOT ? "
+            "AND (SELECT MAX(page) FROM page_results other WHERE other.file_hash = page_results.file_hash) = ? "
+            "ORDER BY created_at DESC LIMIT 1",
+            (quittance_numero, police_numero, police_numero, page, exclude_file_hash, page_count)
+        ).fetchone()
+    return json.loads(row[0]) if row else None
+
+def has_business_keys(conn):
+    with _lock:
+        return conn.execute(
+            "SELECT 1 FROM page_results WHERE quittance_numero IS NOT NULL LIMIT 1"
+        ).fetchone() is not None
+
+def load_document(conn, file_hash, page):
+    with _lock:
+        row = conn.execute(
+            "SELECT data FROM page_results WHERE file_hash = ? AND page = ?",
+            (file_hash, page)
+        ).fetchone()
+    return json.loads(row[0]) if row else None
+
+def load_record(conn, file_hash, page):
+    """
+    Load a document as a schema.Record, memoized per document.
+    """
+    key = (file_hash, page)
+    with _lock:
+        record = _records.get(key)
+        if record is not None:
+            _records.move_to_end(key)
+            return record
+        data = load_document(conn, file_hash, page)
+        if data is None:
+            return None
+        record = _records[key] = to_record(data)
+        if len(_records) > RECORD_CACHE_SIZE:
+            _records.popitem(last=False)
+    return record
+
+def _fields_filter(file_hashes, search=None, categorie=None):
+    # File hashes are passed as a JSON array to avoid SQLite's bound
+    # parameter limit; their position gives the display order.
+    clauses = []
+    params = [json.dumps(list(file_hashes))]
+    if categorie:
+        clauses.append("f.field_id IN (SELECT id FROM field_names WHERE categorie = ?)")
+        params.append(categorie)
+    if search:
+        clauses.append(
+            "(f.valeur LIKE ? OR f.field_id IN "
+            "(SELECT id FROM field_names WHERE nom LIKE ? OR categorie LIKE ?))"
+        )
+        pattern = f"%{search}%"
+        params.extend([pattern, pattern, pattern])
+    where = " AND ".join(clauses)
+    return (f"WHERE {where}" if where else ""), params
+
+def count_fields(conn, file_hashes, search=None, categorie=None):
+    where, params = _fields_filter(file_hashes, search, categorie)
+    with _lock:
+        return conn.execute(
+            "SELECT COUNT(*) FROM page_fields f "
+            "JOIN json_each(?) s ON s.value = f.file_hash " + where,
+            params
+        ).fetchone()[0]
+
+def query_fields(conn, file_hashes, search=None, categorie=None, limit=None, offset=0):
+    """
+    Return (file_hash, page, categorie, nom, valeur) rows for the given files,
+    in upload order, optionally filtered and paginated.
+    """
+    where, params = _fields_filter(file_hashes, search, categorie)
+    sql = (
+        "SELECT f.file_hash, f.page, f.field_id, f.valeur FROM page_fields f "
+        "JOIN json_each(?) s ON s.value = f.file_hash " + where +
+        " ORDER BY s.key, f.page, f.position"
+    )
+    if limit is not None:
+        sql += " LIMIT ? OFFSET ?"
+        params.extend([limit, offset])
+    with _lock:
+        rows = conn.execute(sql, params).fetchall()
+        _, names = _load_field_names(conn)
+        if any(row[2] not in names for row in rows):
+            # Fields added through another connection
+            _field_names.pop(conn, None)
+            _, names = _load_field_names(conn)
+    return [(file_hash, page) + names[field_id] + (valeur,) for file_hash, page, field_id, valeur in rows]
+
+def list_categories(conn, file_hashes):
+    with _lock:
+        rows = conn.execute(
+            "SELECT DISTINCT n.categorie FROM page_fields f "
+            "JOIN json_each(?) s ON s.value = f.file_hash "
+            "JOIN field_names n ON n.id = f.field_id ORDER BY n.categorie",
+            (json.dumps(list(file_hashes)),)
+        ).fetchall()
+    return [row[0] for row in rows]
+
+def search_documents(conn, query, field=None, limit=100):
+    """
+    Search historical extractions.
+
+    With a field from KEY_FIELDS, the normalized query is matched exactly or
+    as a prefix against the indexed business key. Without a field, the query
+    is run against the full-text index. Returns a list of dicts, most recent
+    (or most relevant) first.
+    """
+    columns = "p.file_hash, p.page, p.source_file, p.created_at, " + ", ".join(f"p.{name}" for name in KEY_FIELDS)
+    
+    if field:
+        if field not in KEY_FIELDS:
+            raise ValueError(f"Unknown search field: {field}")
+        value = normalize_key(query)
+        if not value:
+            return []
+        # GLOB is case sensitive and can use the B-tree index for prefixes
+        sql = (
+            f"SELECT {columns} FROM page_results p WHERE p.{field} GLOB ? "
+            "ORDER BY p.created_at DESC LIMIT ?"
+        )
+        params = (value + '*', limit)
+    else:
+        tokens = re.findall(r'\w+', query or '')
+        if not tokens:
+            return []
+        sql = (
+            f"SELECT {columns} FROM documents_fts JOIN page_results p ON p.rowid = documents_fts.rowid "
+            "WHERE documents_fts MATCH ? ORDER BY documents_fts.rank LIMIT ?"
+        )
+        params = (" ".join(f'"{token}"*' for token in tokens), limit)
+    
+    with _lock:
+        rows = conn.execute(sql, params).fetchall()
+    names = ['file_hash', 'page', 'source_file', 'created_at'] + KEY_FIELDS
+    return [dict(zip(names, row)) for row in rows]
+
+def daily_usage(conn, user, day):
+    """
+    Return the (tokens, cost) charged to a user on a day (ISO date).
+    """
+    with _lock:
+        row = conn.execute(
+            "SELECT tokens, cost FROM usage WHERE user = ? AND day = ?", (user, day)
+        ).fetchone()
+    return row if row else (0, 0.0)
+
+def reserve_usage(conn, user, day, tokens, cost, token_limit=None, cost_limit=None):
+    """
+    Charge tokens and cost to a user's day unless that would exceed one of
+    the limits. Checked and charged in a single write transaction, so that
+    concurrent sessions or processes cannot overrun the budget together.
+    Returns (reserved, tokens used, cost used) with the usage before the charge.
+    """
+    with _lock:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT tokens, cost FROM usage WHERE user = ? AND day = ?", (user, day)
+            ).fetchone()
+            used_tokens, used_cost = row if row else (0, 0.0)
+            if (token_limit and used_tokens + tokens > token_limit) or (cost_limit and used_cost + cost > cost_limit):
+                conn.execute("COMMIT")
+                return False, used_tokens, used_cost
+            _add_usage(conn, user, day, tokens, cost)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return True, used_tokens, used_cost
+
+def add_usage(conn, user, day, tokens, cost):
+    # Adjust a user's day, e.g. by the difference between actual and reserved usage
+    with _lock:
+        _add_usage(conn, user, day, tokens, cost)
+
+def _add_usage(conn, user, day, tokens, cost):
+    conn.execute(
+        "INSERT INTO usage (user, day, tokens, cost) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (user, day) DO UPDATE SET tokens = tokens + excluded.tokens, cost = cost + excluded.cost",
+        (user, day, tokens, cost)
+    )
+
+def list_templates(conn):
+    """
+    Return (id, fingerprint, observations) for every known page layout.
+    """
+    with _lock:
+        return conn.execute("SELECT id, fingerprint, observations FROM templates").fetchall()
+
+
+def load_template_zones(conn, template_id):
+    """
+    Return {field: (x0, y0, x1, y1, hits, misses)} for a template, with
+    coordinates relative to the page size.
+    """
+    with _lock:
+        rows = conn.execute(
+            "SELECT field, x0, y0, x1, y1, hits, misses FROM template_zones WHERE template_id = ?",
+            (template_id,)
+        ).fetchall()
+    return {row[0]: row[1:] for row in rows}
+
+def record_template_observation(conn, fingerprint, located, find_template):
+    """
+    Record one observed page of a layout. find_template(templates) picks the
+    template of the layout among list_templates() rows, or returns None to
+    create one with this fingerprint. located maps each filled field to the
+    box (x0, y0, x1, y1) its value was found in, or None when it was not
+    found. Positions are averaged and counted in SQL, in one transaction
+    with the template lookup, so that pages of the same new layout
+    processed at once share one template and keep all their counts.
+    Returns the template id.
+    """
+    with _lock:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            template_id = find_template(
+                conn.execute("SELECT id, fingerprint, observations FROM templates").fetchall()
+            )
+            if template_id is None:
+                template_id = conn.execute(
+                    "INSERT INTO templates (fingerprint, created_at) VALUES (?, ?)",
+                    (fingerprint, datetime.now().isoformat())
+                ).lastrowid
+            conn.execute(
+                "UPDATE templates SET observations = observations + 1 WHERE id = ?",
+                (template_id,)
+            )
+            conn.executemany(
+                "INSERT INTO template_zones (template_id, field, x0, y0, x1, y1, hits) "
+                "VALUES (?, ?, ?, ?, ?, ?, 1) "
+                "ON CONFLICT (template_id, field) DO UPDATE SET "
+                "x0 = (coalesce(x0, 0) * hits + excluded.x0) / (hits + 1), "
+                "y0 = (coalesce(y0, 0) * hits + excluded.y0) / (hits + 1), "
+                "x1 = (coalesce(x1, 0) * hits + excluded.x1) / (hits + 1), "
+                "y1 = (coalesce(y1, 0) * hits + excluded.y1) / (hits + 1), "
+                "hits = hits + 1",
+                [(template_id, field) + tuple(box) for field, box in located.items() if box is not None]
+            )
+            conn.executemany(
+                "INSERT INTO template_zones (template_id, field, misses) VALUES (?, ?, 1) "
+                "ON CONFLICT (template_id, field) DO UPDATE SET misses = misses + 1",
+                [(template_id, field) for field, box in located.items() if box is None]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return template_id
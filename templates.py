@@ -0,0 +1,277 @@
+"""
+Template-based local extraction for recurring page layouts.
+
+Most documents are one of a few OGAR quittance layouts. Each page layout is
+identified by a perceptual fingerprint, and every confident model
+extraction teaches the template where each field's value sits on the page:
+the extracted value is looked up among the words found by a local OCR
+engine (Tesseract), and the bounding box of the match is recorded.
+
+Once a template has been observed enough times and its frequently filled
+fields are consistently located, new pages with the same layout are read
+from those zones of a single OCR of the page, fully offline. Pages with an
+unknown layout, with a low-confidence zone, or with text in the zone of a
+field the template has seen filled too rarely to rely on, still go to the
+model. Learning stops after MAX_LEARNING_OBSERVATIONS pages of a layout. A zonal result only holds the fields of the template's zones: a
+field never located on that layout is returned empty.
+
+Requires the optional pytesseract package and the tesseract binary; when
+they are missing, templates are disabled and every page goes to the model.
+"""
+import copy
+import functools
+import logging
+import os
+import re
+import unicodedata
+
+from PIL import Image, ImageOps
+
+from store import list_templates, load_template_zones, record_template_observation
+
+logger = logging.getLogger(__name__)
+
+@functools.lru_cache(maxsize=None)
+def _load_tesseract():
+    """
+    Return the pytesseract module, or None when it or the tesseract binary
+    is not installed. Loaded on first use rather than at import, since
+    probing the binary starts a process.
+    """
+    try:
+        import pytesseract
+        pytesseract.get_tesseract_version()
+        return pytesseract
+    except Exception:
+        return None
+
+def templates_enabled():
+    return os.getenv('OGAR_TEMPLATES', '1') == '1' and _load_tesseract() is not None
+
+TESSERACT_LANG = os.getenv('OGAR_TESSERACT_LANG', 'fra')
+
+# Fingerprint grid: a difference hash over a (FINGERPRINT_SIZE + 1) x
+# FINGERPRINT_SIZE thumbnail keeps the page structure and drops the text
+FINGERPRINT_SIZE = 16
+# Maximum share of differing fingerprint bits for two pages to share a layout
+MAX_FINGERPRINT_DISTANCE = 0.12
+
+# A template is used once it has been observed this many times...
+MIN_OBSERVATIONS = 3
+# ...and every field filled in at least half of its pages was located in
+# at least this share of them
+MIN_ZONE_RELIABILITY = 0.8
+# Stop learning a template after this many observations, whether or not it
+# became ready: each one costs a full-page OCR
+MAX_LEARNING_OBSERVATIONS = 20
+# Minimum Tesseract word confidence (0-100) for a zone to be trusted
+MIN_ZONE_CONFIDENCE = int(os.getenv('OGAR_ZONE_MIN_CONFIDENCE', '80'))
+# Fields that must be read with confidence for a zonal result to be kept
+REQUIRED_FIELDS = ('informations_police.police_numero', 'informations_police.quittance_numero')
+
+# Zone padding, relative to the page size
+ZONE_MARGIN_X = 0.01
+ZONE_MARGIN_Y = 0.004
+
+def fingerprint(image):
+    """
+    Perceptual difference hash of the page layout, as a hex string prefixed
+    with the page orientation.
+    """
+    gray = ImageOps.autocontrast(image.convert('L'))
+    small = gray.resize((FINGERPRINT_SIZE + 1, FINGERPRINT_SIZE), Image.BILINEAR)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(FINGERPRINT_SIZE):
+        for col in range(FINGERPRINT_SIZE):
+            left = pixels[row * (FINGERPRINT_SIZE + 1) + col]
+            right = pixels[row * (FINGERPRINT_SIZE + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    orientation = 'P' if image.height >= image.width else 'L'
+    return f"{orientation}{bits:0{FINGERPRINT_SIZE * FINGERPRINT_SIZE // 4}x}"
+
+def fingerprint_distance(a, b):
+    if a[0] != b[0]:
+        return 1.0
+    return bin(int(a[1:], 16) ^ int(b[1:], 16)).count('1') / (FINGERPRINT_SIZE * FINGERPRINT_SIZE)
+
+def match_template(store, page_fingerprint):
+    """
+    Return (template_id, observations) of the closest known layout, or None.
+    """
+    return _closest(page_fingerprint, list_templates(store))
+
+def _closest(page_fingerprint, templates):
+    # Closest of the (id, fingerprint, observations) templates, or None
+    best = None
+    for template_id, template_fingerprint, observations in templates:
+        distance = fingerprint_distance(page_fingerprint, template_fingerprint)
+        if distance <= MAX_FINGERPRINT_DISTANCE and (best is None or distance < best[0]):
+            best = (distance, template_id, observations)
+    return best[1:] if best else None
+
+def _normalize(text):
+    text = unicodedata.normalize('NFKD', str(text)).encode('ascii', 'ignore').decode()
+    return re.sub(r'[^0-9a-z]', '', text.lower())
+
+def ocr_words(image):
+    """
+    Run Tesseract on the whole page and return (text, x0, y0, x1, y1, conf)
+    for each word, with coordinates relative to the page size.
+    """
+    pytesseract = _load_tesseract()
+    data = pytesseract.image_to_data(image, lang=TESSERACT_LANG, output_type=pytesseract.Output.DICT)
+    width, height = image.size
+    words = []
+    for i, text in enumerate(data['text']):
+        if text.strip() and float(data['conf'][i]) >= 0:
+            words.append((
+                text,
+                data['left'][i] / width,
+                data['top'][i] / height,
+                (data['left'][i] + data['width'][i]) / width,
+                (data['top'][i] + data['height'][i]) / height,
+                float(data['conf'][i])
+            ))
+    return words
+
+def leaf_fields(data, prefix=''):
+    """
+    Yield (dotted path, value) for every scalar field of an extraction.
+    """
+    for key, value in data.items():
+        path = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            yield from leaf_fields(value, path)
+        elif not isinstance(value, list):
+            yield path, value
+
+def locate_value(value, words, max_words=12):
+    """
+    Return the bounding box of the only run of consecutive OCR words that
+    spells value, or None when it is not found or ambiguous.
+    """
+    target = _normalize(value)
+    if len(target) < 3:
+        return None
+    normalized = [_normalize(word[0]) for word in words]
+    matches = []
+    for start in range(len(words)):
+        text = ''
+        for end in range(start, min(start + max_words, len(words))):
+            text += normalized[end]
+            if not target.startswith(text):
+                break
+            if text == target:
+                run = words[start:end + 1]
+                matches.append((
+                    min(w[1] for w in run), min(w[2] for w in run),
+                    max(w[3] for w in run), max(w[4] for w in run)
+                ))
+                break
+    return matches[0] if len(matches) == 1 else None
+
+def _ready_zones(zones, observations):
+    """
+    Return the zones to read for a template, or None when the template is
+    not reliable enough yet.
+    """
+    if observations < MIN_OBSERVATIONS:
+        return None
+    ready = {}
+    for field, (x0, y0, x1, y1, hits, misses) in zones.items():
+        seen = hits + misses
+        reliability = hits / seen if seen else 0
+        if seen * 2 >= observations and reliability < MIN_ZONE_RELIABILITY:
+            # A field that is usually filled cannot be located reliably
+            return None
+        if hits and reliability >= MIN_ZONE_RELIABILITY:
+            ready[field] = (x0, y0, x1, y1)
+    if not all(field in ready for field in REQUIRED_FIELDS):
+        return None
+    return ready
+
+def learn_template(store, image, data):
+    """
+    Record where the fields of a model extraction are located on the page,
+    creating the template when the layout is new.
+    """
+    if not templates_enabled() or not isinstance(data, dict) or 'raw_text' in data:
+        return
+    page_fingerprint = fingerprint(image)
+    match = match_template(store, page_fingerprint)
+    if match and match[1] >= MAX_LEARNING_OBSERVATIONS:
+        return
+    
+    words = ocr_words(image)
+    located = {
+        field: locate_value(value, words)
+        for field, value in leaf_fields(data) if value not in (None, '')
+    }
+    # The layout is matched again with the observation, a concurrent page
+    # may have created its template meanwhile
+    record_template_observation(
+        store, page_fingerprint, located,
+        lambda templates: (_closest(page_fingerprint, templates) or (None,))[0]
+    )
+
+def zone_text(words, zone):
+    """
+    Gather the OCR words of a page whose center falls in a zone. Returns
+    (text, confidence) where confidence is that of the least confident
+    word, or (text, None) for an empty zone.
+    """
+    x0, y0, x1, y1 = zone
+    inside = [
+        (text, conf) for text, wx0, wy0, wx1, wy1, conf in words
+        if x0 - ZONE_MARGIN_X <= (wx0 + wx1) / 2 <= x1 + ZONE_MARGIN_X
+        and y0 - ZONE_MARGIN_Y <= (wy0 + wy1) / 2 <= y1 + ZONE_MARGIN_Y
+    ]
+    if not inside:
+        return '', None
+    return ' '.join(text for text, _ in inside), min(conf for _, conf in inside)
+
+def zonal_extract(store, image, result_template):
+    """
+    Read a page locally from the zones of its template. Returns the
+    extraction in the structure of result_template, or None when the
+    layout is unknown, a zone is not read with enough confidence, or a
+    rarely filled field has a value on this page.
+    """
+    if not templates_enabled():
+        return None
+    match = match_template(store, fingerprint(image))
+    if not match:
+        return None
+    template_id, observations = match
+    learned = load_template_zones(store, template_id)
+    zones = _ready_zones(learned, observations)
+    if not zones:
+        return None
+    
+    # A single OCR of the page serves every zone
+    words = ocr_words(image)
+    # Fields located before but not reliably enough to be read locally:
+    # when one of them is filled, the model reads the page
+    for field, (x0, y0, x1, y1, hits, _) in learned.items():
+        if hits and field not in zones and zone_text(words, (x0, y0, x1, y1))[1] is not None:
+            logger.info("Zone %s of template %s is filled, page sent to the model", field, template_id)
+            return None
+    
+    data = copy.deepcopy(result_template)
+    for field, zone in zones.items():
+        text, confidence = zone_text(words, zone)
+        if confidence is None:
+            if field in REQUIRED_FIELDS:
+                return None
+            continue
+        if confidence < MIN_ZONE_CONFIDENCE:
+            logger.info("Zone %s of template %s read with confidence %.0f", field, template_id, confidence)
+            return None
+        
+        *parents, name = field.split('.')
+        target = data
+        for parent in parents:
+            target = target.setdefault(parent, {})
+        target[name] = text
+    return data
@@ -0,0 +1,56 @@
+"""
+Smoke test of the extraction page.
+
+Runs app.py with Streamlit's AppTest harness, logged in, with one uploaded
+image and the model call stubbed out, and clicks the extraction button.
+
+Run with:
+    python -m pytest -q test_app.py
+"""
+import io
+import os
+
+import pytest
+import streamlit as st
+from PIL import Image
+from streamlit.testing.v1 import AppTest
+
+import extraction
+from schema import RESULT_TEMPLATE
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+class FakeUpload(io.BytesIO):
+    # The parts of Streamlit's UploadedFile the app uses
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
+
+def png_bytes():
+    buffer = io.BytesIO()
+    Image.new('RGB', (800, 1100), 'white').save(buffer, 'PNG')
+    return buffer.getvalue()
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('OGAR_API_KEY', 'test-key')
+    upload = FakeUpload('quittance.png', png_bytes())
+    monkeypatch.setattr(st, 'file_uploader', lambda *args, **kwargs: [upload])
+    monkeypatch.setattr(
+        extraction, 'extract_data_from_image',
+        lambda *args, **kwargs: RESULT_TEMPLATE
+    )
+    st.cache_resource.clear()
+    app = AppTest.from_file(APP_PATH, default_timeout=60)
+    app.session_state["logged_in"] = True
+    app.session_state["username"] = "test"
+    return app
+
+def test_upload_and_extract(app):
+    app.run()
+    assert not app.exception, app.exception
+    
+    next(button for button in app.button if "Extraire" in button.label).click().run()
+    assert not app.exception, app.exception
+    assert any("Données extraites" in message.value for message in app.success)
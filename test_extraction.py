@@ -0,0 +1,149 @@
+"""
+Tests of the extraction pipeline, with the model calls stubbed out.
+
+Run with:
+    python -m pytest -q test_extraction.py
+"""
+import copy
+import io
+import time
+import zipfile
+from collections import Counter
+
+import pytest
+from PIL import Image
+
+import extraction
+from schema import RESULT_TEMPLATE
+from store import load_document, open_store
+
+def jpeg_bytes(color):
+    buffer = io.BytesIO()
+    Image.new('RGB', (600, 800), color).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+def quittance(page):
+    data = copy.deepcopy(RESULT_TEMPLATE)
+    data['informations_police']['police_numero'] = 'P-1234'
+    data['informations_police']['quittance_numero'] = 'Q-42'
+    data['informations_police']['page'] = page
+    return data
+
+@pytest.fixture
+def store(tmp_path):
+    conn = open_store(str(tmp_path / 'results.db'))
+    yield conn
+    conn.close()
+
+def test_separate_page_scans_are_not_reused_for_each_other(store, monkeypatch):
+    # Both JPEGs carry the numbers of quittance Q-42, the second one must
+    # still be extracted rather than get the first one's data
+    calls = []
+    
+    def extract(client, image, prompt=extraction.DEFAULT_PROMPT, **kwargs):
+        calls.append(prompt)
+        return quittance(len(calls))
+    
+    monkeypatch.setattr(extraction, 'extract_data_from_image', extract)
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zf:
+        zf.writestr('q42_p1.jpg', jpeg_bytes('white'))
+        zf.writestr('q42_p2.jpg', jpeg_bytes('gray'))
+    
+    stats = Counter()
+    items, complete = extraction.process_upload(None, store, archive, 'q42.zip', stats=stats)
+    
+    assert complete
+    assert calls == [extraction.DEFAULT_PROMPT, extraction.DEFAULT_PROMPT]
+    assert [load_document(store, key, page)['informations_police']['page'] for key, page, _, _ in items] == [1, 2]
+    assert stats['extracted'] == 2 and not stats['reused']
+
+def test_zonal_errors_fall_back_to_the_model(store, monkeypatch):
+    def zonal_extract(store, image, result_template):
+        raise RuntimeError("tesseract crashed")
+    
+    monkeypatch.setattr(extraction, 'zonal_extract', zonal_extract)
+    monkeypatch.setattr(extraction, 'extract_data_from_image', lambda *args, **kwargs: quittance(1))
+    errors = []
+    stats = Counter()
+    items, complete = extraction.process_upload(
+        None, store, io.BytesIO(jpeg_bytes('white')), 'scan.jpg', on_error=errors.append, stats=stats
+    )
+    
+    assert complete and not errors
+    assert stats['extracted'] == 1
+
+def warm_hedger(kind):
+    hedger = extraction.Hedger(percentile=50, max_ratio=1, min_samples=2)
+    for _ in range(2):
+        hedger.call(lambda cancelled: 'fast', kind=kind)
+    return hedger
+
+def test_hedge_answering_first_wins_and_both_requests_count():
+    hedger = warm_hedger('extraction')
+    attempts = []
+    
+    def attempt(cancelled):
+        attempts.append(cancelled)
+        if len(attempts) == 1:
+            # The primary request hangs until cancelled
+            cancelled.wait(5)
+            return None
+        return 'hedge'
+    
+    stats = Counter()
+    assert hedger.call(attempt, stats, kind='extraction') == ('hedge', 2)
+    assert stats == Counter(hedged=1, hedge_wins=1)
+    assert attempts[0].is_set()
+    assert hedger.delay('identification') is None
+
+def test_failed_request_of_a_hedged_call_is_not_counted():
+    hedger = warm_hedger('extraction')
+    attempts = []
+    
+    def attempt(cancelled):
+        attempts.append(cancelled)
+        if len(attempts) == 1:
+            time.sleep(0.05)
+            raise RuntimeError("overloaded")
+        time.sleep(0.1)
+        return 'hedge'
+    
+    stats = Counter()
+    assert hedger.call(attempt, stats, kind='extraction') == ('hedge', 1)
+    assert stats == Counter(hedged=1, hedge_wins=1)
+
+def test_tokens_of_failed_pdf_pages_are_counted(store, tmp_path, monkeypatch):
+    # Poppler is stubbed out: a two-page PDF whose second page fails after
+    # its model call was paid for
+    monkeypatch.setattr(extraction, 'MEMORY_LIMIT_MB', 0)
+    monkeypatch.setattr(extraction, 'pdf_info', lambda path, source_file='': {'Pages': '2'})
+    monkeypatch.setattr(extraction, 'pdf_page_texts', lambda path: [])
+    monkeypatch.setattr(extraction, 'has_business_keys', lambda store: False)
+    monkeypatch.setattr(
+        extraction, 'pdf_to_images',
+        lambda path, first_page, last_page, source_file='', dpi=None: [
+            Image.new('RGB', (600, 800), 'white' if first_page == 1 else 'gray')
+        ]
+    )
+    calls = []
+    
+    def extract(client, image, prompt=extraction.DEFAULT_PROMPT, stats=None, **kwargs):
+        calls.append(prompt)
+        stats['input_tokens'] += 1000
+        if image.getpixel((0, 0)) != (255, 255, 255):
+            raise RuntimeError("malformed response")
+        return quittance(1)
+    
+    monkeypatch.setattr(extraction, 'extract_data_from_image', extract)
+    pdf_path = tmp_path / 'scan.pdf'
+    pdf_path.write_bytes(b'%PDF-1.4')
+    errors = []
+    stats = Counter()
+    pages, complete = extraction.process_pdf(
+        None, store, 'key', str(pdf_path), 'scan.pdf', on_error=errors.append, stats=stats
+    )
+    
+    assert not complete and len(errors) == 1
+    assert len(calls) == 2 and stats['input_tokens'] == 2000
+    assert stats['extracted'] == 1
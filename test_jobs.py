@@ -0,0 +1,105 @@
+"""
+Tests of the shared job store: claims, leases, heartbeats and retries.
+
+Run with:
+    python -m pytest -q test_jobs.py
+"""
+import io
+
+import pytest
+
+import jobs
+import worker
+from jobs import (
+    batch_jobs, claim_job, enqueue_batch, fail_job, finish_job, heartbeat, open_jobs, read_job_data
+)
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = open_jobs(str(tmp_path / 'jobs.db'))
+    yield conn
+    conn.close()
+
+def job_data(conn, job_id):
+    fileobj = io.BytesIO()
+    read_job_data(conn, job_id, fileobj)
+    return fileobj.getvalue()
+
+def statuses(conn, batch_id):
+    return [(job['status'], job['attempts']) for job in batch_jobs(conn, batch_id)]
+
+def test_jobs_are_claimed_once_in_upload_order(conn):
+    batch_id, job_ids = enqueue_batch(conn, [('a.pdf', io.BytesIO(b'a')), ('b.pdf', io.BytesIO(b'b'))])
+    
+    assert claim_job(conn, 'w1') == (job_ids[0], 'a.pdf', False)
+    assert claim_job(conn, 'w2') == (job_ids[1], 'b.pdf', False)
+    assert claim_job(conn, 'w3') is None
+    assert statuses(conn, batch_id) == [('running', 1), ('running', 1)]
+
+def test_uploads_are_copied_in_chunks(conn, monkeypatch):
+    monkeypatch.setattr(jobs, 'CHUNK_SIZE', 7)
+    data = bytes(range(256)) * 3
+    upload = io.BytesIO(data)
+    upload.seek(100)
+    _, [job_id, empty_id] = enqueue_batch(conn, [('a.pdf', upload), ('b.pdf', io.BytesIO())])
+    
+    assert job_data(conn, job_id) == data
+    assert job_data(conn, empty_id) == b''
+
+def test_only_the_lease_holder_renews_and_finishes(conn):
+    batch_id, [job_id] = enqueue_batch(conn, [('a.pdf', io.BytesIO(b'a'))])
+    claim_job(conn, 'w1')
+    
+    assert heartbeat(conn, job_id, 'w1')
+    assert not heartbeat(conn, job_id, 'w2')
+    assert not finish_job(conn, job_id, 'w2', {'items': []})
+    assert finish_job(conn, job_id, 'w1', {'items': []})
+    assert not heartbeat(conn, job_id, 'w1')
+    assert batch_jobs(conn, batch_id)[0]['result'] == {'items': []}
+
+def test_expired_lease_is_taken_over(conn):
+    batch_id, [job_id] = enqueue_batch(conn, [('a.pdf', io.BytesIO(b'a'))])
+    claim_job(conn, 'w1', lease_seconds=-1)
+    
+    assert claim_job(conn, 'w2')[0] == job_id
+    assert not heartbeat(conn, job_id, 'w1')
+    assert not finish_job(conn, job_id, 'w1', {'items': []})
+    assert statuses(conn, batch_id) == [('running', 2)]
+
+def test_failed_job_is_retried_up_to_max_attempts(conn, monkeypatch):
+    monkeypatch.setattr(jobs, 'MAX_ATTEMPTS', 2)
+    batch_id, [job_id] = enqueue_batch(conn, [('a.pdf', io.BytesIO(b'a'))])
+    
+    claim_job(conn, 'w1')
+    assert fail_job(conn, job_id, 'w1', RuntimeError('first'))
+    assert statuses(conn, batch_id) == [('pending', 1)]
+    
+    assert claim_job(conn, 'w2')[0] == job_id
+    assert fail_job(conn, job_id, 'w2', RuntimeError('second'))
+    [job] = batch_jobs(conn, batch_id)
+    assert (job['status'], job['error']) == ('failed', 'second')
+    assert claim_job(conn, 'w3') is None
+
+def test_job_abandoned_by_its_workers_is_given_up(conn, monkeypatch):
+    monkeypatch.setattr(jobs, 'MAX_ATTEMPTS', 2)
+    batch_id, _ = enqueue_batch(conn, [('a.pdf', io.BytesIO(b'a'))])
+    claim_job(conn, 'w1', lease_seconds=-1)
+    claim_job(conn, 'w2', lease_seconds=-1)
+    
+    assert claim_job(conn, 'w3') is None
+    [job] = batch_jobs(conn, batch_id)
+    assert job['status'] == 'failed' and job['error'] == 'Abandoned after 2 attempts'
+
+def test_worker_runs_the_upload_from_a_temporary_file(conn, monkeypatch):
+    uploads = []
+    
+    def process_upload(client, store, fileobj, name, **kwargs):
+        uploads.append((name, fileobj.read(), isinstance(fileobj, io.BytesIO)))
+        return [], True
+    
+    monkeypatch.setattr(worker, 'process_upload', process_upload)
+    batch_id, _ = enqueue_batch(conn, [('a.pdf', io.BytesIO(b'%PDF-1.4'))])
+    
+    assert worker.Worker(None, None, conn).run_once()
+    assert uploads == [('a.pdf', b'%PDF-1.4', False)]
+    assert batch_jobs(conn, batch_id)[0]['status'] == 'done'
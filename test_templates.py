@@ -0,0 +1,87 @@
+"""
+Tests of template learning, with the OCR engine stubbed out.
+
+Run with:
+    python -m pytest -q test_templates.py
+"""
+import threading
+import time
+
+import pytest
+from PIL import Image, ImageDraw
+
+import templates
+from store import list_templates, load_template_zones, open_store
+
+# OCR words of the stubbed page: (text, x0, y0, x1, y1, confidence)
+WORDS = [
+    ('Police', 0.10, 0.10, 0.20, 0.12, 95.0),
+    ('P-1234', 0.25, 0.10, 0.35, 0.12, 95.0),
+    ('Quittance', 0.10, 0.20, 0.22, 0.22, 95.0),
+    ('Q-42', 0.25, 0.20, 0.32, 0.22, 95.0),
+]
+
+EXTRACTION = {
+    'informations_police': {'police_numero': 'P-1234', 'quittance_numero': 'Q-42', 'assure': 'Absent'}
+}
+
+def page():
+    image = Image.new('L', (600, 800), 'white')
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((50, 50, 550, 120), fill='black')
+    draw.rectangle((50, 600, 300, 750), fill='gray')
+    return image
+
+def ocr_words(image):
+    # Slow enough for concurrent pages to all look the layout up first
+    time.sleep(0.05)
+    return WORDS
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(templates, 'templates_enabled', lambda: True)
+    monkeypatch.setattr(templates, 'ocr_words', ocr_words)
+    conn = open_store(str(tmp_path / 'results.db'))
+    yield conn
+    conn.close()
+
+def test_concurrent_pages_of_a_new_layout_share_one_template(store):
+    pages = 8
+    barrier = threading.Barrier(pages)
+    
+    def learn():
+        barrier.wait()
+        templates.learn_template(store, page(), EXTRACTION)
+    
+    threads = [threading.Thread(target=learn) for _ in range(pages)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    [(template_id, _, observations)] = list_templates(store)
+    assert observations == pages
+    zones = load_template_zones(store, template_id)
+    assert zones['informations_police.police_numero'][4:] == (pages, 0)
+    assert zones['informations_police.police_numero'][:4] == pytest.approx((0.25, 0.10, 0.35, 0.12))
+    assert zones['informations_police.assure'][4:] == (0, pages)
+
+def test_ready_template_reads_zones_from_one_page_ocr(store, monkeypatch):
+    calls = []
+    monkeypatch.setattr(templates, 'ocr_words', lambda image: calls.append(image) or WORDS)
+    located = {'informations_police': {'police_numero': 'P-1234', 'quittance_numero': 'Q-42'}}
+    for _ in range(templates.MIN_OBSERVATIONS):
+        templates.learn_template(store, page(), located)
+    calls.clear()
+    
+    data = templates.zonal_extract(store, page(), {'informations_police': {}})
+    
+    assert len(calls) == 1
+    assert data['informations_police'] == {'police_numero': 'P-1234', 'quittance_numero': 'Q-42'}
+
+def test_learning_stops_after_max_observations(store, monkeypatch):
+    monkeypatch.setattr(templates, 'MAX_LEARNING_OBSERVATIONS', 2)
+    for _ in range(4):
+        templates.learn_template(store, page(), {'informations_police': {'assure': 'Absent'}})
+    [(_, _, observations)] = list_templates(store)
+    assert observations == 2
@@ -0,0 +1,247 @@
+"""
+Watch-folder ingestion daemon.
+
+Watches a directory where scanners drop PDFs, images or archives, waits
+until each file is fully written, and runs it through the extraction
+pipeline with bounded concurrency. For every file a JSON and an Excel
+output are written, then the file is moved to a done or failed folder.
+
+File system events are used when the optional watchdog package is
+installed, with a periodic directory scan as fallback (and as a safety net
+for missed events).
+
+Run with:
+    python watcher.py /srv/scans --workers 4
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from anthropic import Anthropic
+
+from exports import records_frame, write_excel
+from extraction import ARCHIVE_EXTENSIONS, DOCUMENT_EXTENSIONS, process_upload
+from schema import to_record
+from store import open_store, load_document
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    # watchdog not installed, the directory is polled
+    Observer = None
+
+logger = logging.getLogger("watcher")
+
+SUPPORTED_EXTENSIONS = DOCUMENT_EXTENSIONS + ARCHIVE_EXTENSIONS
+
+def is_candidate(path):
+    name = os.path.basename(path)
+    return (
+        os.path.isfile(path)
+        and not name.startswith(('.', '~$'))
+        and name.lower().endswith(SUPPORTED_EXTENSIONS)
+    )
+
+def unique_path(directory, name):
+    # Never overwrite an earlier file with the same name
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        return path
+    stem, ext = os.path.splitext(name)
+    return os.path.join(directory, f"{stem}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}{ext}")
+
+class FolderWatcher:
+    """
+    Tracks candidate files until their size and modification time have
+    been stable for settle_time seconds, then hands them to a worker pool.
+    """
+    def __init__(self, client, store, watch_dir, output_dir, done_dir, failed_dir,
+                 workers=2, poll_interval=2.0, settle_time=5.0, force_refresh=False):
+        self.client = client
+        self.store = store
+        self.watch_dir = watch_dir
+        self.output_dir = output_dir
+        self.done_dir = done_dir
+        self.failed_dir = failed_dir
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.force_refresh = force_refresh
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        
+        # path -> (size, mtime, time the file was first seen with them)
+        self.pending = {}
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        
+        for directory in (output_dir, done_dir, failed_dir):
+            os.makedirs(directory, exist_ok=True)
+    
+    def notice(self, path):
+        if is_candidate(path) and os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.watch_dir):
+            with self.lock:
+                if path not in self.in_flight:
+                    self.pending.setdefault(path, None)
+    
+    def scan(self):
+        for entry in os.scandir(self.watch_dir):
+            self.notice(entry.path)
+    
+    def submit_ready(self):
+        """
+        Submit the pending files whose size and mtime have not changed for
+        settle_time seconds, i.e. that the scanner has finished writing.
+        """
+        now = time.monotonic()
+        with self.lock:
+            for path, seen in list(self.pending.items()):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    del self.pending[path]
+                    continue
+                
+                signature = (stat.st_size, stat.st_mtime)
+                if seen is None or seen[:2] != signature:
+                    self.pending[path] = signature + (now,)
+                elif stat.st_size > 0 and now - seen[2] >= self.settle_time:
+                    del self.pending[path]
+                    self.in_flight.add(path)
+                    self.executor.submit(self.process, path)
+    
+    def process(self, path):
+        name = os.path.basename(path)
+        stem = os.path.splitext(name)[0]
+        errors = []
+        stats = Counter()
+        logger.info("Processing %s", name)
+        
+        try:
+            with open(path, 'rb') as f:
+                items, complete = process_upload(
+                    self.client, self.store, f, name,
+                    force_refresh=self.force_refresh,
+                    on_error=lambda e: errors.append(str(e)),
+                    stats=stats
+                )
+            
+            documents = []
+            records = []
+            for key, page, source_file, display_page in items:
+                data = load_document(self.store, key, page)
+                documents.append({'source_file': source_file, 'page': display_page or None, 'data': data})
+                records.append((source_file, display_page, to_record(data)))
+            
+            with open(unique_path(self.output_dir, f"{stem}.json"), 'w', encoding='utf-8') as f:
+                json.dump(
+                    {'source_file': name, 'complete': complete, 'errors': errors, 'documents': documents},
+                    f, ensure_ascii=False, indent=2
+                )
+            if records:
+                write_excel(records_frame(records), unique_path(self.output_dir, f"{stem}.xlsx"))
+        except Exception as e:
+            logger.exception("Failed to process %s", name)
+            errors.append(str(e))
+            complete = False
+        
+        try:
+            target_dir = self.done_dir if complete else self.failed_dir
+            shutil.move(path, unique_path(target_dir, name))
+            logger.info(
+                "%s %s (%d extracted, %d reused, %d truncated, %d error(s))",
+                name, "done" if complete else "failed", stats['extracted'], stats['reused'],
+                stats['truncated'], len(errors)
+            )
+        except OSError:
+            logger.exception("Failed to move %s", name)
+        finally:
+            with self.lock:
+                self.in_flight.discard(path)
+    
+    def run(self):
+        observer = None
+        if Observer is not None:
+            watcher = self
+            
+            class Handler(FileSystemEventHandler):
+                def on_created(self, event):
+                    watcher.notice(event.src_path)
+                
+                def on_modified(self, event):
+                    watcher.notice(event.src_path)
+                
+                def on_moved(self, event):
+                    watcher.notice(event.dest_path)
+            
+            observer = Observer()
+            observer.schedule(Handler(), self.watch_dir, recursive=False)
+            observer.start()
+            logger.info("Watching %s for file system events", self.watch_dir)
+        else:
+            logger.info("watchdog not installed, polling %s every %.1fs", self.watch_dir, self.poll_interval)
+        
+        # With events, the full scan only runs now and then to catch missed files
+        scan_every = 30.0 if observer else self.poll_interval
+        last_scan = 0.0
+        try:
+            while True:
+                if time.monotonic() - last_scan >= scan_every:
+                    self.scan()
+                    last_scan = time.monotonic()
+                self.submit_ready()
+                time.sleep(min(self.poll_interval, 1.0))
+        except KeyboardInterrupt:
+            logger.info("Stopping, waiting for files in progress")
+        finally:
+            if observer:
+                observer.stop()
+                observer.join()
+            self.executor.shutdown(wait=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract documents dropped into a folder.")
+    parser.add_argument("watch_dir", help="Directory where scanned documents are dropped")
+    parser.add_argument("--output-dir", help="Directory for JSON/Excel outputs (default: WATCH_DIR/output)")
+    parser.add_argument("--done-dir", help="Directory for processed files (default: WATCH_DIR/done)")
+    parser.add_argument("--failed-dir", help="Directory for failed files (default: WATCH_DIR/failed)")
+    parser.add_argument("--workers", type=int, default=2, help="Files processed concurrently")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="Seconds between directory scans without watchdog")
+    parser.add_argument("--settle-time", type=float, default=5.0, help="Seconds a file must stay unchanged before processing")
+    parser.add_argument("--force-refresh", action="store_true", help="Do not reuse prior extractions")
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
+    
+    api_key = os.getenv('OGAR_API_KEY')
+    if not api_key:
+        parser.error("OGAR_API_KEY is not set")
+    
+    watch_dir = args.watch_dir
+    FolderWatcher(
+        Anthropic(api_key=api_key),
+        open_store(),
+        watch_dir,
+        args.output_dir or os.path.join(watch_dir, 'output'),
+        args.done_dir or os.path.join(watch_dir, 'done'),
+        args.failed_dir or os.path.join(watch_dir, 'failed'),
+        workers=args.workers,
+        poll_interval=args.poll_interval,
+        settle_time=args.settle_time,
+        force_refresh=args.force_refresh
+    ).run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Extraction worker.
+
+Consumes the shared job store (see jobs.py): claims queued uploads, runs
+them through the extraction pipeline against the shared result store, and
+records each job's result for the front end that queued it. Run as many
+worker processes as throughput requires, on the host of the databases
+(see jobs.py); the HTTP API can also run workers in process.
+
+Run with:
+    python worker.py --threads 4
+"""
+import argparse
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+
+from anthropic import Anthropic
+
+from extraction import SPOOL_DIR, error_to_dict, process_upload
+from jobs import LEASE_SECONDS, claim_job, fail_job, finish_job, heartbeat, open_jobs, read_job_data
+from store import open_store
+
+logger = logging.getLogger("worker")
+
+class Worker:
+    """
+    Claims and runs jobs one at a time, renewing the lease of the running
+    job from a heartbeat thread.
+    """
+    def __init__(self, client, store, jobs, name=None, lease_seconds=LEASE_SECONDS, poll_interval=1.0):
+        self.client = client
+        self.store = store
+        self.jobs = jobs
+        self.name = name or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+    
+    def keep_alive(self, job_id, finished):
+        while not finished.wait(self.lease_seconds / 3):
+            if not heartbeat(self.jobs, job_id, self.name, self.lease_seconds):
+                logger.warning("Lost the lease of job %s", job_id)
+                return
+    
+    def run_once(self):
+        """
+        Run the next job. Returns False when the queue was empty.
+        """
+        job = claim_job(self.jobs, self.name, self.lease_seconds)
+        if job is None:
+            return False
+        job_id, name, force_refresh = job
+        logger.info("Processing job %s (%s)", job_id, name)
+        
+        finished = threading.Event()
+        threading.Thread(target=self.keep_alive, args=(job_id, finished), daemon=True).start()
+        errors = []
+        stats = Counter()
+        try:
+            # The upload is copied out of the job database to a temporary
+            # file rather than loaded in memory
+            with tempfile.TemporaryFile(dir=SPOOL_DIR) as upload:
+                read_job_data(self.jobs, job_id, upload)
+                upload.seek(0)
+                items, complete = process_upload(
+                    self.client, self.store, upload, name,
+                    force_refresh=force_refresh,
+                    on_error=lambda e: errors.append(error_to_dict(e)),
+                    stats=stats
+                )
+            result = {'items': items, 'complete': complete, 'errors': errors, 'stats': dict(stats)}
+            if not finish_job(self.jobs, job_id, self.name, result):
+                logger.warning("Job %s was taken over, result dropped", job_id)
+        except Exception as e:
+            logger.exception("Job %s failed", job_id)
+            fail_job(self.jobs, job_id, self.name, e)
+        finally:
+            finished.set()
+        return True
+    
+    def run(self, stop=None):
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                if not self.run_once():
+                    stop.wait(self.poll_interval)
+            except Exception:
+                # e.g. the job database is locked for longer than the timeout
+                logger.exception("Worker %s could not claim a job", self.name)
+                stop.wait(self.poll_interval)
+
+def start_workers(client, store, jobs, count):
+    """
+    Run count workers on daemon threads of this process. Returns the event
+    that stops them.
+    """
+    stop = threading.Event()
+    for _ in range(count):
+        threading.Thread(target=Worker(client, store, jobs).run, args=(stop,), daemon=True).start()
+    return stop
+
+def main():
+    parser = argparse.ArgumentParser(description="Run extraction jobs from the shared job store.")
+    parser.add_argument("--threads", type=int, default=2, help="Jobs processed concurrently by this process")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds between polls of an empty queue")
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
+    
+    api_key = os.getenv('OGAR_API_KEY')
+    if not api_key:
+        parser.error("OGAR_API_KEY is not set")
+    
+    client = Anthropic(api_key=api_key)
+    store = open_store()
+    jobs = open_jobs()
+    stop = threading.Event()
+    threads = [
+        threading.Thread(
+            target=Worker(client, store, jobs, poll_interval=args.poll_interval).run, args=(stop,)
+        )
+        for _ in range(args.threads)
+    ]
+    for thread in threads:
+        thread.start()
+    logger.info("%d worker thread(s) started", len(threads))
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logger.info("Stopping, waiting for jobs in progress")
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+if __name__ == "__main__":
+    main()